@@ -0,0 +1,123 @@
+"""
+Arc fitting: runs of polyline vertices lying on a circle are drawn as one G2/G3 move.
+
+Candidate runs are consecutive vertices whose circles (through each vertex and its two
+neighbours) agree, then every run is checked against the circle through its first, middle
+and last points: all its vertices must be within tolerance of the circle, it must turn one
+way by less than a full turn, and each chord must stay within tolerance of the arc (so a
+regular polygon is not rounded into a circle). Runs failing the check are split in two and
+checked again. Everything works on the whole point buffer of a PathSet at once.
+"""
+
+import numpy as np
+
+from app.pathset import PathSet
+
+# Kind of move ending at each point
+LINE = 0
+SKIPPED = 1  # inside an arc
+CW = 2  # G2
+CCW = 3  # G3
+
+MIN_RUN = 3  # points of the shortest arc (it replaces 2 segments)
+
+
+def circumcenters(a, b, c):
+    """Centers of the circles through the points a, b, c (rows), nan for collinear points"""
+    ab, ac = b - a, c - a
+    d = 2 * (ab[:, 0] * ac[:, 1] - ab[:, 1] * ac[:, 0])
+    ab2 = (ab**2).sum(axis=1)
+    ac2 = (ac**2).sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ux = (ac[:, 1] * ab2 - ab[:, 1] * ac2) / d
+        uy = (ab[:, 0] * ac2 - ac[:, 0] * ab2) / d
+    centers = a + np.column_stack([ux, uy])
+    centers[d == 0] = np.nan
+    return centers
+
+
+def candidate_runs(points, path_ids, tolerance, max_radius):
+    """(start, end) point indices of the runs of vertices that seem to lie on one circle"""
+    a, b, c = points[:-2], points[1:-1], points[2:]
+    centers = circumcenters(a, b, c)
+    radii = np.hypot(*(b - centers).T)
+    turns = np.sign((b - a)[:, 0] * (c - b)[:, 1] - (b - a)[:, 1] * (c - b)[:, 0])
+    # Vertex k + 1 (the middle of a, b, c) can be inside an arc
+    valid = (path_ids[:-2] == path_ids[2:]) & (turns != 0) & (radii < max_radius)
+
+    # Two neighbouring vertices are on the same arc when each one's next/previous point is on the other's circle
+    linked = valid[:-1] & valid[1:] & (turns[:-1] == turns[1:])
+    with np.errstate(invalid="ignore"):
+        linked &= np.abs(np.hypot(*(points[3:] - centers[:-1]).T) - radii[:-1]) <= tolerance
+        linked &= np.abs(np.hypot(*(points[:-3] - centers[1:]).T) - radii[1:]) <= tolerance
+
+    # Runs of valid vertices joined by links: the run of vertices k0 + 1..k1 + 1 is the arc of points k0..k1 + 2
+    starts = np.flatnonzero(valid & ~np.concatenate([[False], linked]))
+    ends = np.flatnonzero(valid & ~np.concatenate([linked, [False]])) + 2
+
+    # Consecutive runs overlap by up to two points, a run starts where the previous one ends
+    starts[1:] = np.maximum(starts[1:], ends[:-1])
+    keep = ends - starts + 1 >= MIN_RUN
+    return starts[keep], ends[keep]
+
+
+def check_runs(points, starts, ends, tolerance, max_radius):
+    """Centers and turn direction of the circles through the first, middle and last points of the runs, and whether each run fits"""
+    middles = (starts + ends) // 2
+    centers = circumcenters(points[starts], points[middles], points[ends])
+    radii = np.hypot(*(points[starts] - centers).T)
+    fits = np.isfinite(radii) & (radii < max_radius)
+    centers[~fits] = 0.0
+    radii[~fits] = 0.0
+
+    # Every point of a run, and every segment (from the point to the next one)
+    counts = ends - starts + 1
+    run_of_point = np.repeat(np.arange(len(starts)), counts)
+    point = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts, counts)
+    errors = np.abs(np.hypot(*(points[point] - centers[run_of_point]).T) - radii[run_of_point])
+
+    segment = point[:-1][np.diff(run_of_point) == 0]
+    run_of_segment = run_of_point[:-1][np.diff(run_of_point) == 0]
+    u = points[segment] - centers[run_of_segment]
+    v = points[segment + 1] - centers[run_of_segment]
+    angles = np.arctan2(u[:, 0] * v[:, 1] - u[:, 1] * v[:, 0], (u * v).sum(axis=1))
+    chords = np.hypot(*(v - u).T)
+    r = radii[run_of_segment]
+    sagittas = r - np.sqrt(np.maximum(r**2 - chords**2 / 4, 0.0))
+
+    first_point = np.cumsum(counts) - counts
+    first_segment = first_point - np.arange(len(starts))
+    direction = np.sign(angles[first_segment])
+    fits &= np.maximum.reduceat(errors, first_point) <= tolerance
+    fits &= np.maximum.reduceat(sagittas, first_segment) <= tolerance
+    fits &= np.minimum.reduceat(angles * direction[run_of_segment], first_segment) > 0
+    fits &= np.abs(np.add.reduceat(angles, first_segment)) < 1.9 * np.pi
+    return centers, direction, fits
+
+
+def fit_arcs(paths: PathSet, tolerance: float, max_radius: float = 1000.0) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Kind of the move ending at every point (LINE, SKIPPED, CW or CCW) and, for the arc ends,
+    the center relative to the start of the arc (the I and J of the G2/G3 move).
+    """
+    points = paths.points
+    kinds = np.zeros(len(points), dtype=np.int8)
+    offsets = np.zeros((len(points), 2))
+    if len(points) < MIN_RUN or tolerance <= 0:
+        return kinds, offsets
+
+    starts, ends = candidate_runs(points, paths.path_ids(), tolerance, max_radius)
+    while len(starts):
+        centers, direction, fits = check_runs(points, starts, ends, tolerance, max_radius)
+        for start, end, center, turn in zip(starts[fits], ends[fits], centers[fits], direction[fits]):
+            kinds[start + 1 : end] = SKIPPED
+            kinds[end] = CCW if turn > 0 else CW
+            offsets[end] = center - points[start]
+
+        # Split the runs that don't fit in two halves sharing their middle point
+        starts, ends = starts[~fits], ends[~fits]
+        keep = ends - starts + 1 >= 2 * MIN_RUN - 1
+        starts, ends = starts[keep], ends[keep]
+        middles = (starts + ends) // 2
+        starts, ends = np.concatenate([starts, middles]), np.concatenate([middles, ends])
+    return kinds, offsets
@@ -0,0 +1,201 @@
+"""
+Batch conversion of many SVGs with the same parameters.
+
+Every file is converted in a worker process and its G-code is written to the output directory
+as soon as it is done. A file that fails is reported and the batch goes on. A report.json
+with the per-file timings and errors is written next to the G-code:
+
+    uv run python -m app.batch drawings/ -o gcode/ --width 300 --height 200 --optimize
+"""
+
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Iterator
+import argparse
+import io
+import json
+import logging
+import multiprocessing
+import sys
+import tempfile
+import time
+import zipfile
+
+from app.gcode_sender import unique_filename
+from app.metrics import StageMetrics, timed
+from app.pipeline import SVGParams, convert_svg, convert_svg_layers, warm_worker
+from app.utils import iter_layers_gcode
+
+
+def write_gcode(path: Path, layers: list, params: SVGParams) -> int:
+    """Streams the G-code of the layers to a file, returns its size"""
+    size = 0
+    tmp_path = path.with_suffix(".gcode.tmp")
+    with open(tmp_path, "w") as f:
+        for block in iter_layers_gcode(layers, z_lift=params.clearance, feedrate=params.feedrate, pen_change=params.penChangeCommand, arc_tolerance=params.arcTolerance):
+            f.write(block)
+            size += len(block)
+    tmp_path.replace(path)
+    return size
+
+
+def convert_file(name: str, source: str | bytes, params: SVGParams, output_path: str) -> dict:
+    """Worker entry point: converts one SVG (a path or its content) and writes its G-code, never raises"""
+    start = time.perf_counter()
+    metrics = StageMetrics()
+    try:
+        svg_data = Path(source).read_bytes() if isinstance(source, str) else source
+        if params.multiLayer:
+            conversion = convert_svg_layers(svg_data, params, metrics)
+        else:
+            conversion = convert_svg(svg_data, params, metrics=metrics)
+        with timed(metrics, "write"):
+            size = write_gcode(Path(output_path), conversion.layers, params)
+    except Exception as e:
+        return {"file": name, "status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": time.perf_counter() - start}
+
+    return {
+        "file": name,
+        "status": "ok",
+        "output": Path(output_path).name,
+        "seconds": time.perf_counter() - start,
+        "gcodeBytes": size,
+        "penLifts": conversion.plot_data["penLifts"],
+        "estimatedTimeMinutes": conversion.plot_data["estimatedTimeMinutes"],
+        "timings": metrics.as_dict()["timings"],
+    }
+
+
+def run_batch(
+    files: list[tuple[str, str | bytes]], params: SVGParams, output_dir: Path, executor: Executor, max_in_flight: int | None = None
+) -> Iterator[dict]:
+    """
+    Converts (name, path or content) files in the executor, yields the result of each file as it completes.
+    At most max_in_flight files are submitted at a time (all of them if None), so that work submitted to
+    a shared executor meanwhile doesn't wait for the whole batch.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    # Files with the same name (from different folders) get name(2), name(3)...
+    taken = set()
+    outputs = []
+    for name, source in files:
+        stem = unique_filename(Path(name).stem, taken)
+        taken.add(f"{stem}.gcode")
+        outputs.append((name, source, str(output_dir / f"{stem}.gcode")))
+
+    futures: dict[Future, str] = {}
+    for name, source, output_path in outputs:
+        while max_in_flight and len(futures) >= max_in_flight:
+            yield from _completed(futures)
+        futures[executor.submit(convert_file, name, source, params, output_path)] = name
+    while futures:
+        yield from _completed(futures)
+
+
+def _completed(futures: dict[Future, str]) -> Iterator[dict]:
+    """Waits for at least one of the futures, removes and yields the results of the completed ones"""
+    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+    for future in done:
+        name = futures.pop(future)
+        try:
+            yield future.result()
+        except Exception as e:  # the worker died (e.g. out of memory)
+            yield {"file": name, "status": "failed", "error": f"{type(e).__name__}: {e}", "seconds": None}
+
+
+def batch_report(results: list[dict], seconds: float) -> dict:
+    failed = [result for result in results if result["status"] != "ok"]
+    return {"files": len(results), "failed": len(failed), "seconds": seconds, "results": results}
+
+
+def convert_archive(archive: bytes, params: SVGParams, executor: Executor, max_in_flight: int | None = None) -> bytes:
+    """Converts the SVGs of a zip archive, returns a zip archive of their G-code and report.json (see run_batch for max_in_flight)"""
+    with zipfile.ZipFile(io.BytesIO(archive)) as svg_zip:
+        files = [(info.filename, svg_zip.read(info)) for info in svg_zip.infolist() if not info.is_dir() and info.filename.lower().endswith(".svg")]
+    if not files:
+        raise ValueError("The archive contains no .svg file")
+
+    start = time.perf_counter()
+    with tempfile.TemporaryDirectory() as directory:
+        output_dir = Path(directory)
+        results = list(run_batch(files, params, output_dir, executor, max_in_flight))
+        report = batch_report(results, time.perf_counter() - start)
+
+        output = io.BytesIO()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as gcode_zip:
+            for result in results:
+                if result["status"] == "ok":
+                    gcode_zip.write(output_dir / result["output"], result["output"])
+            gcode_zip.writestr("report.json", json.dumps(report, indent=2))
+    return output.getvalue()
+
+
+def svg_files(inputs: list[str]) -> list[tuple[str, str]]:
+    """(name, path) of the given SVG files and of the SVG files in the given folders"""
+    files = []
+    for item in map(Path, inputs):
+        paths = sorted(item.glob("*.svg")) if item.is_dir() else [item]
+        files += [(str(path), str(path)) for path in paths]
+    return files
+
+
+def _init_worker(verbose: bool):
+    if verbose:  # the pipeline logs its debug lines
+        logging.getLogger("app").setLevel(logging.DEBUG)
+    warm_worker()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="SVG files or folders of SVG files")
+    parser.add_argument("-o", "--output", required=True, help="folder for the G-code files and report.json")
+    parser.add_argument("--width", type=float, required=True, help="page width (mm)")
+    parser.add_argument("--height", type=float, required=True, help="page height (mm)")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="polyline simplification tolerance")
+    parser.add_argument("--clearance", type=float, default=5, help="pen lift (mm)")
+    parser.add_argument("--feedrate", type=int, default=5000, help="drawing feedrate (mm/min)")
+    parser.add_argument("--optimize", action="store_true", help="order the paths to minimize travel")
+    parser.add_argument("--flip-vertically", action="store_true")
+    parser.add_argument("--flip-horizontally", action="store_true")
+    parser.add_argument("--multi-layer", action="store_true", help="keep the SVG layers, with a pen change between them")
+    parser.add_argument("--params", default="{}", help="JSON of any other SVGParams fields, e.g. '{\"mergeTolerance\": 0.2}'")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: one per core)")
+    parser.add_argument("--verbose", action="store_true", help="log the debug lines of the pipeline")
+    args = parser.parse_args(argv)
+
+    params = SVGParams(
+        width=args.width,
+        height=args.height,
+        outputFile="batch",
+        polylineTolerance=args.tolerance,
+        clearance=args.clearance,
+        optimize=args.optimize,
+        feedrate=args.feedrate,
+        flipVertically=args.flip_vertically,
+        flipHorizontally=args.flip_horizontally,
+        multiLayer=args.multi_layer,
+        **json.loads(args.params),
+    )
+    files = svg_files(args.inputs)
+    output_dir = Path(args.output)
+
+    start = time.perf_counter()
+    results = []
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context, initializer=_init_worker, initargs=(args.verbose,)) as executor:
+        for result in run_batch(files, params, output_dir, executor):
+            results.append(result)
+            if result["status"] == "ok":
+                print(f"[{len(results)}/{len(files)}] {result['file']} -> {result['output']} ({result['seconds']:.2f}s)")
+            else:
+                print(f"[{len(results)}/{len(files)}] {result['file']} FAILED: {result['error']}", file=sys.stderr)
+
+    report = batch_report(results, time.perf_counter() - start)
+    (output_dir / "report.json").write_text(json.dumps(report, indent=2))
+    print(f"{report['files'] - report['failed']}/{report['files']} files converted in {report['seconds']:.2f}s")
+    return 1 if report["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from pathlib import Path
+import hashlib
+import json
+import logging
+import threading
+import numpy as np
+
+from app.pathset import PathSet, concat_pathsets
+
+logger = logging.getLogger(__name__)
+
+
+def cache_key(svg_data: bytes, **params) -> str:
+    """Content address of a processing request: hash of the SVG and of the parameters affecting the geometry"""
+    digest = hashlib.sha256(svg_data)
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+class PathCache:
+    """
+    Size bounded LRU cache of processed paths (layers, each a PathSet).
+
+    Entries are kept in memory up to max_bytes. If a directory is given, entries are also
+    written there as .npz files (bounded by max_disk_bytes) and reloaded on a memory miss,
+    so they survive restarts.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 2**20, directory: str | None = None, max_disk_bytes: int = 2 * 2**30):
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.directory = Path(directory) if directory else None
+        if self.directory:
+            self.directory.mkdir(parents=True, exist_ok=True)
+
+        self._entries: OrderedDict[str, list] = OrderedDict()
+        self._sizes: dict[str, int] = {}
+        self._total = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str) -> list | None:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key]
+
+        layers = self._load(key)
+        if layers is not None:
+            self._remember(key, layers)
+        return layers
+
+    def put(self, key: str, layers: list):
+        self._remember(key, layers)
+        self._store(key, layers)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._sizes.clear()
+            self._total = 0
+
+    def _remember(self, key: str, layers: list):
+        size = sum(paths.nbytes for paths in layers)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._total -= self._sizes[key]
+            self._entries[key] = layers
+            self._entries.move_to_end(key)
+            self._sizes[key] = size
+            self._total += size
+
+            # Evict least recently used entries
+            while self._total > self.max_bytes:
+                old_key, _ = self._entries.popitem(last=False)
+                self._total -= self._sizes.pop(old_key)
+
+    def _file(self, key: str) -> Path:
+        return self.directory / f"{key}.npz"
+
+    def _load(self, key: str) -> list | None:
+        if not self.directory or not self._file(key).exists():
+            return None
+        try:
+            with np.load(self._file(key)) as data:
+                points, offsets, layer_offsets = data["points"], data["offsets"], data["layer_offsets"]
+            self._file(key).touch()  # mtime is used as the disk LRU order
+        except Exception as e:
+            logger.warning(f"Could not read cache entry {key}: {e}")
+            return None
+        # Each layer is a slice of the paths, its offsets are made relative to its first point
+        return [
+            PathSet(points[offsets[start] : offsets[end]], offsets[start : end + 1] - offsets[start])
+            for start, end in zip(layer_offsets[:-1], layer_offsets[1:])
+        ]
+
+    def _store(self, key: str, layers: list):
+        if not self.directory:
+            return
+        try:
+            paths = concat_pathsets(layers)
+            points, offsets = paths.points, paths.offsets
+            layer_offsets = np.concatenate([[0], np.cumsum([len(layer) for layer in layers], dtype=np.int64)])
+            tmp_file = self._file(key).with_suffix(".tmp.npz")
+            np.savez(tmp_file, points=points, offsets=offsets, layer_offsets=layer_offsets)
+            tmp_file.replace(self._file(key))
+        except Exception as e:
+            logger.warning(f"Could not write cache entry {key}: {e}")
+            return
+
+        # Evict the oldest files once the directory is over its budget
+        files = sorted(self.directory.glob("*.npz"), key=lambda file: file.stat().st_mtime)
+        total = sum(file.stat().st_size for file in files)
+        while files and total > self.max_disk_bytes:
+            file = files.pop(0)
+            total -= file.stat().st_size
+            file.unlink(missing_ok=True)
@@ -0,0 +1,223 @@
+"""
+Sends G-code programs to a fleet of plotters.
+
+The plotters are configured with SOFIA_PLOTTERS="name=host[:port],..." (by default a single
+plotter named "default" at SOFIA_PLOTTER_HOST, or localhost). Every plotter has a thread taking
+the next queued dispatch meant for it or for any plotter, so uploads to different machines run
+concurrently and a dispatch without a plotter goes to the first idle one. Failed uploads are
+retried with an exponential backoff, then a dispatch without a plotter is tried on the others.
+Programs are uploaded in parts when part_size is set (see PlotterClient.upload_gcode), so the
+retries only send the parts that didn't make it.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Iterable
+import logging
+import os
+import threading
+import time
+import uuid
+
+from app.gcode_sender import PlotterClient, get_client
+
+logger = logging.getLogger(__name__)
+
+
+def plotters_from_env() -> dict[str, str]:
+    """Hostname of each plotter name, from SOFIA_PLOTTERS"""
+    config = os.environ.get("SOFIA_PLOTTERS")
+    if not config:
+        return {"default": os.environ.get("SOFIA_PLOTTER_HOST", "localhost")}
+    plotters = {}
+    for entry in config.split(","):
+        name, _, hostname = entry.strip().partition("=")
+        plotters[name.strip()] = hostname.strip()
+    return plotters
+
+
+class Dispatch:
+    """A program queued for upload, its future is resolved with the file name used on the plotter"""
+
+    def __init__(self, name: str, blocks: Callable[[], Iterable[str]], plotter: str | None = None):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.blocks = blocks
+        self.plotter = plotter  # requested plotter, None for any
+        self.assigned: str | None = None
+        self.tried: set[str] = set()  # plotters that failed all the attempts
+        self.status = "queued"
+        self.attempts = 0
+        self.error: str | None = None
+        self.filename: str | None = None
+        self.bytes_sent = 0  # of the current attempt, including the parts found on the plotter
+        self.future: Future = Future()
+        self.created = time.time()
+
+    def progress(self, bytes_sent: int):
+        self.bytes_sent = bytes_sent
+
+    def as_dict(self) -> dict:
+        return {
+            "dispatchId": self.id,
+            "name": self.name,
+            "plotter": self.assigned or self.plotter,
+            "status": self.status,
+            "attempts": self.attempts,
+            "bytesSent": self.bytes_sent,
+            "filename": self.filename,
+            "error": self.error,
+        }
+
+
+class Plotter:
+    def __init__(self, name: str, hostname: str):
+        self.name = name
+        self.hostname = hostname
+        self.client: PlotterClient = get_client(hostname)
+        self.current: Dispatch | None = None
+        self.sent = 0
+        self.last_error: str | None = None
+
+    def as_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "hostname": self.hostname,
+            "status": "uploading" if self.current else "idle",
+            "dispatchId": self.current.id if self.current else None,
+            "sent": self.sent,
+            "lastError": self.last_error,
+        }
+
+
+class Dispatcher:
+    """Queue of dispatches and the threads uploading them, one per plotter"""
+
+    def __init__(self, plotters: dict[str, str], max_attempts: int = 4, backoff: float = 1.0, max_dispatches: int = 64, part_size: int = 0):
+        self.plotters = {name: Plotter(name, hostname) for name, hostname in plotters.items()}
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.part_size = part_size
+        self.max_dispatches = max_dispatches
+
+        self._queue: list[Dispatch] = []
+        self._dispatches: OrderedDict[str, Dispatch] = OrderedDict()
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._threads: list[threading.Thread] = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._stopped.clear()
+        for plotter in self.plotters.values():
+            thread = threading.Thread(target=self._worker, args=(plotter,), name=f"plotter-{plotter.name}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopped.set()
+        with self._condition:
+            self._condition.notify_all()
+        self._threads = []
+
+    def submit(self, name: str, blocks: Callable[[], Iterable[str]], plotter: str | None = None) -> Dispatch:
+        """Queues a program for the given plotter (any idle one if None), raises KeyError for an unknown plotter"""
+        if plotter is not None and plotter not in self.plotters:
+            raise KeyError(plotter)
+        self.start()
+
+        dispatch = Dispatch(name, blocks, plotter)
+        with self._condition:
+            self._queue.append(dispatch)
+            self._dispatches[dispatch.id] = dispatch
+
+            # Forget the oldest finished dispatches
+            finished = [old_id for old_id, old in self._dispatches.items() if old.future.done()]
+            for old_id in finished[: max(len(self._dispatches) - self.max_dispatches, 0)]:
+                del self._dispatches[old_id]
+
+            self._condition.notify_all()
+        return dispatch
+
+    def get(self, dispatch_id: str) -> Dispatch | None:
+        return self._dispatches.get(dispatch_id)
+
+    def status(self) -> dict:
+        with self._condition:
+            return {
+                "plotters": [plotter.as_dict() for plotter in self.plotters.values()],
+                "queued": [dispatch.as_dict() for dispatch in self._queue],
+            }
+
+    def _next(self, plotter: Plotter) -> Dispatch | None:
+        for dispatch in self._queue:
+            if dispatch.plotter in (None, plotter.name) and plotter.name not in dispatch.tried:
+                self._queue.remove(dispatch)
+                return dispatch
+        return None
+
+    def _worker(self, plotter: Plotter):
+        while not self._stopped.is_set():
+            with self._condition:
+                dispatch = self._next(plotter)
+                if dispatch is None:
+                    self._condition.wait()
+                    continue
+                # Once running the future can't be cancelled (by a request giving up on it), a dispatch queued again already is
+                if not dispatch.future.running() and not dispatch.future.set_running_or_notify_cancel():
+                    dispatch.status = "cancelled"
+                    continue
+                dispatch.assigned = plotter.name
+                dispatch.status = "uploading"
+                plotter.current = dispatch
+
+            try:
+                self._send(plotter, dispatch)
+            except Exception as e:
+                # Keep the thread serving the queue of the plotter whatever went wrong
+                logger.exception(f"Dispatch of {dispatch.name} to {plotter.name} failed")
+                dispatch.status = "failed"
+                dispatch.error = str(e) or type(e).__name__
+                if not dispatch.future.done():
+                    dispatch.future.set_exception(e)
+            finally:
+                plotter.current = None
+
+    def _send(self, plotter: Plotter, dispatch: Dispatch):
+        """Uploads with retries, waiting backoff, 2 * backoff, 4 * backoff... between the attempts"""
+        for attempt in range(self.max_attempts):
+            dispatch.attempts = attempt + 1
+            dispatch.bytes_sent = 0
+            try:
+                dispatch.filename = plotter.client.upload_gcode(dispatch.name, dispatch.blocks, progress=dispatch.progress, part_size=self.part_size)
+            except Exception as e:
+                dispatch.error = str(e) or type(e).__name__
+                plotter.last_error = dispatch.error
+                logger.warning(f"Upload of {dispatch.name} to {plotter.name} failed (attempt {attempt + 1}/{self.max_attempts}): {dispatch.error}")
+                if attempt + 1 == self.max_attempts or self._stopped.wait(self.backoff * 2**attempt):
+                    self._failed(plotter, dispatch, e)
+                    return
+                continue
+
+            logger.info(f"Sent {dispatch.filename}.gcode to {plotter.name}")
+            dispatch.status = "sent"
+            dispatch.error = None
+            plotter.sent += 1
+            if not dispatch.future.done():
+                dispatch.future.set_result(dispatch.filename)
+            return
+
+    def _failed(self, plotter: Plotter, dispatch: Dispatch, error: Exception):
+        """Queues the dispatch again for the plotters it hasn't been tried on, if it can go to any"""
+        dispatch.tried.add(plotter.name)
+        with self._condition:
+            if dispatch.plotter is None and not self._stopped.is_set() and set(self.plotters) - dispatch.tried:
+                logger.info(f"Queueing {dispatch.name} again for another plotter")
+                dispatch.status = "queued"
+                self._queue.append(dispatch)
+                self._condition.notify_all()
+                return
+        dispatch.status = "failed"
+        if not dispatch.future.done():
+            dispatch.future.set_exception(error)
@@ -1,103 +1,232 @@
 from fastapi import HTTPException
+from typing import Callable, Iterable
 import requests
+from requests.adapters import HTTPAdapter
+import itertools
+import threading
+import time
 import re
 import logging
+import zlib
+
+from app.utils import iter_chunks
+from app import metrics
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global variables for GCODE state
-current_gcode_text = ""
-filename = ""
-
-
-def set_gcode_data(gcode_text: str, file_name: str):
-    """Set the current GCODE data"""
-    global current_gcode_text, filename
-    current_gcode_text = gcode_text
-    filename = file_name
-
-
-async def send_gcode(hostname: str):
-    """Send GCODE to the plotter machine"""
-    global current_gcode_text, filename
-    hostname = "localhost"
-
-    logger.info(f"Attempting to connect to plotter at hostname: {hostname}")
-
-    # Attempt to connect to the machine
-    connect_url = f"http://{hostname}/machine/connect"
-    logger.info(f"Trying to connect to: {connect_url}")
-
-    try:
-        logger.info(f"Attempting HTTP GET request to: {connect_url}")
-        conn_res = requests.get(connect_url, timeout=10)
-        logger.info(f"Response received: {conn_res.status_code}")
-        session_key = conn_res.json()["sessionKey"]
-        logger.info("Successfully connected to plotter, session key obtained")
 
-    except requests.exceptions.ConnectionError as e:
-        logger.error(f"Connection refused when trying to connect to {hostname} at {connect_url}")
-        logger.error(f"Connection error details: {str(e)}")
+def unique_filename(name: str, existing: set[str]) -> str:
+    """First of name, name(2), name(3)... whose .gcode file is not in existing"""
+    while f"{name}.gcode" in existing:
+        match = re.match(r"^(.*?)(\((\d+)\))?$", name.split(".")[0])
+        base, _, num = match.groups()
+        num = int(num) + 1 if num else 2
+        name = f"{base}({num})"
+    return name
+
+
+class PlotterClient:
+    """
+    HTTP client for the Duet (DSF) REST API of a plotter.
+
+    Connections are kept alive in a pool and the session key of /machine/connect is reused
+    until the plotter answers 401, then it is requested again. The methods block, the async
+    wrappers run them in a thread so uploads don't hold up the event loop.
+    """
+
+    def __init__(self, hostname: str, pool_size: int = 4):
+        self.hostname = hostname
+        self.base_url = f"http://{hostname}"
+        self.session = requests.Session()
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+        self._session_key = None
+        self._lock = threading.Lock()
+
+    def connect(self) -> str:
+        """Requests a new session key"""
+        res = self.session.get(f"{self.base_url}/machine/connect", timeout=10)
+        res.raise_for_status()
+        # Some firmware versions send the key as a number, headers must be strings
+        self._session_key = str(res.json()["sessionKey"])
+        logger.info(f"Connected to plotter at {self.hostname}, session key obtained")
+        return self._session_key
+
+    def request(self, method: str, path: str, data=None, timeout: float = 10, **kwargs) -> requests.Response:
+        """
+        Request with the session key, reconnects and retries once if the key has expired.
+        data may be a callable returning the body, so a streamed body can be generated again for the retry.
+        """
+        for attempt in range(2):
+            with self._lock:
+                session_key = self._session_key or self.connect()
+
+            body = data() if callable(data) else data
+            res = self.session.request(
+                method, f"{self.base_url}{path}", data=body, headers={"X-Session-Key": session_key}, timeout=timeout, **kwargs
+            )
+            if res.status_code != 401 or attempt:
+                return res
+
+            logger.info("Plotter session key expired, reconnecting")
+            with self._lock:
+                if self._session_key == session_key:
+                    self._session_key = None
+
+    def file_sizes(self, directory: str = "gcodes") -> dict[str, int]:
+        """Size of each file in a directory of the plotter"""
+        res = self.request("GET", f"/machine/directory/{directory}")
+        if res.status_code == 404:
+            return {}
+        res.raise_for_status()
+        return {entry["name"]: entry.get("size") for entry in res.json() if entry.get("type") != "d"}
+
+    def list_files(self, directory: str = "gcodes") -> set[str]:
+        """Names of the files in a directory of the plotter"""
+        return set(self.file_sizes(directory))
+
+    def file_size(self, path: str) -> int | None:
+        """Size of a file of the plotter, None if it doesn't exist"""
+        res = self.request("GET", f"/machine/fileinfo/{path}")
+        if res.status_code == 404:
+            return None
+        res.raise_for_status()
+        return res.json().get("size")
+
+    def move(self, source: str, target: str):
+        res = self.request("POST", "/machine/file/move", data={"from": source, "to": target, "force": "false"})
+        if not res.ok:
+            raise HTTPException(status_code=500, detail=f"Failed to move {source} to {target} on the plotter. Status: {res.status_code}")
+
+    def upload(self, path: str, blocks: Callable[[], Iterable[str]], timeout: float = 30, progress: Callable[[int], None] | None = None) -> requests.Response:
+        """
+        Uploads text blocks, a generator body makes requests use chunked transfer encoding.
+        progress is called with the number of bytes sent so far after every chunk.
+        """
+        if not metrics.ENABLED and progress is None:
+            body = lambda: (chunk.encode() for chunk in iter_chunks(blocks()))
+            return self.request("PUT", f"/machine/file/{path}", data=body, timeout=timeout)
+
+        sent = 0
+
+        def body():
+            nonlocal sent
+            sent = 0  # the body is generated again if the request is retried
+            for chunk in iter_chunks(blocks()):
+                data = chunk.encode()
+                sent += len(data)
+                yield data
+                if progress:
+                    progress(sent)
+
+        start = time.perf_counter()
+        res = self.request("PUT", f"/machine/file/{path}", data=body, timeout=timeout)
+        if metrics.ENABLED:
+            duration = time.perf_counter() - start
+            metrics.registry.observe("upload", duration)
+            metrics.registry.increment("upload_bytes", sent)
+            metrics.registry.increment("uploads")
+            logger.info(f"Uploaded {sent} bytes in {duration:.2f}s")
+        return res
+
+    def upload_checked(self, path: str, blocks: Callable[[], Iterable[str]], progress: Callable[[int], None] | None = None):
+        """Uploads to a staging name, checks the size of the file on the plotter then moves it to path"""
+        staging = f"{path}.part"
+        sent = 0
+
+        def report(size: int):
+            nonlocal sent
+            sent = size
+            if progress:
+                progress(size)
+
+        res = self.upload(staging, blocks, progress=report)
+        logger.info(f"Upload response status: {res.status_code}")
+        if res.status_code != 201:
+            logger.error(f"Failed to upload GCODE. Status: {res.status_code}, Response: {res.text}")
+            raise HTTPException(status_code=500, detail=f"Failed to send GCODE to plotter. Status: {res.status_code}")
+
+        size = self.file_size(staging)
+        if size != sent:
+            raise HTTPException(status_code=500, detail=f"Upload of {path} is incomplete: {size} of {sent} bytes on the plotter")
+        self.move(staging, path)
+
+    def upload_parts(self, directory: str, blocks: Callable[[], Iterable[str]], part_size: int, progress: Callable[[int], None] | None = None) -> list[str]:
+        """
+        Uploads text blocks as files of about part_size bytes, skipping the ones already on the plotter.
+        A part is named after its index and CRC-32, so a file of that name and size is that part.
+        Returns the paths of the parts.
+        """
+        existing = self.file_sizes(directory)
+        paths = []
+        done = 0
+        resumed = 0
+        for index, chunk in enumerate(iter_chunks(blocks(), part_size)):
+            data = chunk.encode()
+            name = f"{index:04d}-{zlib.crc32(data):08x}.gcode"
+            path = f"{directory}/{name}"
+            if existing.get(name) == len(data):
+                resumed += len(data)
+            else:
+                res = self.request("PUT", f"/machine/file/{path}", data=data, timeout=30)
+                if res.status_code != 201:
+                    raise HTTPException(status_code=500, detail=f"Failed to send part {index} of GCODE to plotter. Status: {res.status_code}")
+                if self.file_size(path) != len(data):
+                    raise HTTPException(status_code=500, detail=f"Upload of {path} is incomplete")
+            paths.append(path)
+            done += len(data)
+            if progress:
+                progress(done)
+
+        if resumed:
+            logger.info(f"Resumed upload to {directory}: {resumed} of {done} bytes were already on the plotter")
+        return paths
+
+    def upload_gcode(self, name: str, blocks: Callable[[], Iterable[str]], progress: Callable[[int], None] | None = None, part_size: int = 0) -> str:
+        """
+        Uploads a program to gcodes/, renamed to name(2), name(3)... if the name is taken. Returns the name used.
+
+        The program is written to a staging name and only moved to its name once complete. With a part_size (bytes)
+        it is uploaded in parts to gcodes/name.parts/ and another attempt only sends the missing parts. The program
+        file then holds the first block (the setup lines, so every part runs with its modal state) and calls the parts
+        with M98. progress is called with the number of bytes of the program sent so far.
+        """
+        name = unique_filename(name, self.list_files("gcodes"))
+        logger.info(f"Uploading GCODE file as: {name}.gcode")
+
+        if part_size > 0:
+            setup = next(iter(blocks()), "")
+            parts = self.upload_parts(f"gcodes/{name}.parts", lambda: itertools.islice(blocks(), 1, None), part_size, progress)
+            main = setup + "".join(f'M98 P"0:/{path}"\n' for path in parts)
+            self.upload_checked(f"gcodes/{name}.gcode", lambda: [main])
+        else:
+            self.upload_checked(f"gcodes/{name}.gcode", blocks, progress)
+        return name
+
+
+# One client (and connection pool) per plotter
+_clients: dict[str, PlotterClient] = {}
+
+
+def get_client(hostname: str) -> PlotterClient:
+    if hostname not in _clients:
+        _clients[hostname] = PlotterClient(hostname)
+    return _clients[hostname]
+
+
+def upload_error(hostname: str, e: Exception) -> HTTPException:
+    """HTTP error to answer with when an upload to a plotter failed"""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, requests.exceptions.ConnectionError):
+        logger.error(f"Connection error with plotter at {hostname}: {str(e)}")
         logger.error(f"This may be a Docker networking issue - check Docker network configuration")
-        raise HTTPException(
+        return HTTPException(
             status_code=503, detail=f"Failed to connect to plotter at {hostname}. Make sure the plotter is accessible and the hostname is correct. If running in Docker, check network configuration."
         )
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Timeout when trying to connect to {hostname} at {connect_url}")
-        raise HTTPException(status_code=504, detail=f"Timeout connecting to plotter at {hostname}. The plotter may be unresponsive.")
-    except Exception as e:
-        logger.error(f"Unexpected error when connecting to {hostname}: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error connecting to plotter: {str(e)}")
-
-    try:
-        # Check if file exists and handle naming conflicts
-        while True:
-            file_check_url = f"http://{hostname}/machine/fileinfo/gcodes/{filename}.gcode"
-            logger.info(f"Checking if file exists: {file_check_url}")
-
-            file_exists_res = requests.get(file_check_url, headers={"X-Session-Key": session_key}, timeout=10)
-
-            try:
-                file_exists_res.json()
-            except Exception:
-                break
-
-            if file_exists_res.status_code == 200:
-                logger.info(f"File {filename}.gcode already exists, generating new name")
-                match = re.match(r"^(.*?)(\((\d+)\))?$", filename.split(".")[0])
-                if match:
-                    base, _, num = match.groups()
-                    num = int(num) + 1 if num else 2
-                    filename = f"{base}({num})"
-                logger.info(f"New filename: {filename}")
-
-        logger.info(f"Uploading GCODE file as: {filename}.gcode")
-        logger.info(f"GCODE preview (first 100 chars): {current_gcode_text[:100]}")
-
-        # Upload the GCODE file
-        upload_url = f"http://{hostname}/machine/file/gcodes/{filename}.gcode"
-        logger.info(f"Uploading to: {upload_url}")
-
-        upload_res = requests.put(upload_url, current_gcode_text, headers={"X-Session-Key": session_key}, timeout=30)
-
-        logger.info(f"Upload response status: {upload_res.status_code}")
-        logger.info(f"Upload response: {upload_res.text}")
-
-        if upload_res.status_code != 201:
-            logger.error(f"Failed to upload GCODE. Status: {upload_res.status_code}, Response: {upload_res.text}")
-            raise HTTPException(status_code=500, detail=f"Failed to send GCODE to plotter. Status: {upload_res.status_code}")
-
-        logger.info(f"Successfully uploaded GCODE file: {filename}.gcode")
-        return {"message": f"GCODE successfully sent to plotter as {filename}.gcode"}
-
-    except requests.exceptions.ConnectionError as e:
-        logger.error(f"Connection lost during file operations with {hostname}: {str(e)}")
-        raise HTTPException(status_code=503, detail="Lost connection to plotter during file operations")
-    except requests.exceptions.Timeout as e:
-        logger.error(f"Timeout during file operations with {hostname}: {str(e)}")
-        raise HTTPException(status_code=504, detail="Timeout during file operations with plotter")
-    except Exception as e:
-        logger.error(f"Unexpected error during file operations: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Unexpected error during file operations: {str(e)}")
+    if isinstance(e, requests.exceptions.Timeout):
+        logger.error(f"Timeout communicating with plotter at {hostname}: {str(e)}")
+        return HTTPException(status_code=504, detail=f"Timeout communicating with plotter at {hostname}. The plotter may be unresponsive.")
+    logger.error(f"Unexpected error during file operations: {str(e)}")
+    return HTTPException(status_code=500, detail=f"Unexpected error during file operations: {str(e)}")
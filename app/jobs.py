@@ -0,0 +1,339 @@
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+import multiprocessing
+import logging
+import os
+import threading
+import time
+import uuid
+
+from app.cache import PathCache
+from app.metrics import StageMetrics, registry, timed
+from app.preview import PreviewPyramid
+from app.pipeline import (
+    STAGES,
+    SVGParams,
+    Conversion,
+    JobCancelled,
+    build_plot_data,
+    convert_svg,
+    geometry_key,
+    source_key,
+    pack_source,
+    unpack_source,
+    prepare_source,
+    read_layers,
+    simplify_layer,
+    invert_layers,
+    prepare_layer,
+    warm_worker,
+)
+from app.sessions import Session
+
+logger = logging.getLogger(__name__)
+
+
+class JobSlots:
+    """
+    Stage and cancel flag of the jobs in flight, in shared memory: the workers get the arrays once
+    when they start and report without a round trip to another process. A job holds a slot from
+    its submission until it finishes, jobs submitted when all the slots are taken get None (their
+    stage is not reported and they can only be cancelled while queued).
+    """
+
+    def __init__(self, context, size: int = 1024):
+        self.stages = context.RawArray("b", size)  # index in STAGES + 1, 0 before the first stage
+        self.cancelled = context.RawArray("b", size)
+        self._free = list(range(size - 1, -1, -1))
+        self._slots: dict[str, int] = {}
+
+    def acquire(self, job_id: str) -> int | None:
+        if not self._free:
+            return None
+        slot = self._slots[job_id] = self._free.pop()
+        self.stages[slot] = self.cancelled[slot] = 0
+        return slot
+
+    def release(self, job_id: str):
+        slot = self._slots.pop(job_id, None)
+        if slot is not None:
+            self._free.append(slot)
+
+    def stage(self, job_id: str) -> str | None:
+        slot = self._slots.get(job_id)
+        index = self.stages[slot] if slot is not None else 0
+        return STAGES[index - 1] if index else None
+
+    def set_stage(self, job_id: str, stage: str):
+        slot = self._slots.get(job_id)
+        if slot is not None:
+            self.stages[slot] = STAGES.index(stage) + 1
+
+    def is_cancelled(self, job_id: str) -> bool:
+        slot = self._slots.get(job_id)
+        return slot is not None and bool(self.cancelled[slot])
+
+    def cancel(self, job_id: str) -> bool:
+        """Flags a job for cancellation, returns False if it has no slot"""
+        slot = self._slots.get(job_id)
+        if slot is not None:
+            self.cancelled[slot] = 1
+        return slot is not None
+
+
+# The slot arrays of a worker process (see _init_worker)
+_stages = None
+_cancelled = None
+
+
+def _init_worker(stages, cancelled):
+    """Initializer of the worker processes, keeps the shared slot arrays and warms the worker up"""
+    global _stages, _cancelled
+    _stages, _cancelled = stages, cancelled
+    warm_worker()
+
+
+def _run_conversion(slot: int | None, svg_data: bytes, params: SVGParams, metrics: StageMetrics | None):
+    """Worker process entry point, the stages are reported in the job's slot (see JobSlots). The metrics are filled in and sent back"""
+
+    def report(stage: str):
+        if slot is None:
+            return
+        if _cancelled[slot]:
+            raise JobCancelled()
+        _stages[slot] = STAGES.index(stage) + 1
+
+    return convert_svg(svg_data, params, report, metrics)
+
+
+class Job:
+    """A conversion submitted to the JobManager"""
+
+    def __init__(self, job_id: str, params: SVGParams, future: Future, session: Session | None = None):
+        self.id = job_id
+        self.params = params
+        self.future = future
+        self.session = session
+        self.created = time.time()
+        self._preview: PreviewPyramid | None = None
+        self._preview_lock = threading.Lock()
+
+    @property
+    def result(self) -> Conversion:
+        return self.future.result()
+
+    def preview(self) -> PreviewPyramid:
+        """Preview pyramid of the finished job, built on the first tile request"""
+        with self._preview_lock:
+            if self._preview is None:
+                self._preview = PreviewPyramid(self.result.layers, (self.params.width, self.params.height))
+            return self._preview
+
+
+class JobManager:
+    """
+    Runs SVG conversions in a pool of worker processes so they don't block the event loop.
+
+    Jobs report their current stage (see pipeline.STAGES) and can be cancelled: queued jobs
+    never start, running jobs stop at the next stage boundary. Results are stored in the
+    path cache, a cache hit only rebuilds the preview data (in a thread).
+
+    The source paths (before scaling) are cached as well, when only the page changed the
+    job starts from them in a thread and skips reading the SVG. Jobs of a session reuse
+    the path order of its previous update when the page is only scaled uniformly.
+
+    Every job holds a slot while it runs, the jobs run in threads (cache hits, cached source
+    paths, multi-layer jobs) report their stages and check their cancel flag from the thread.
+
+    Multi-layer jobs are coordinated from a thread: each stage submits one task per layer
+    to the pool, so independent layers are processed on all the cores.
+
+    The workers live as long as the manager (max_workers of them, SOFIA_WORKERS in the API):
+    they import vpype, load its config and convert a small drawing when they start, and read
+    the cancel flags / write the stages in shared memory (see JobSlots), so a small job costs
+    little more than its geometry.
+    """
+
+    def __init__(self, cache: PathCache, max_workers: int | None = None, max_jobs: int = 32):
+        self.cache = cache
+        self.max_workers = max_workers or os.cpu_count()
+        self.max_jobs = max_jobs
+
+        self._jobs: OrderedDict[str, Job] = OrderedDict()
+        self._lock = threading.RLock()
+        self._pool = None
+        self._threads = None
+        self._slots = None
+        self._warm = []
+
+    def start(self):
+        """Starts the worker pool (also done on the first submit)"""
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context("spawn")
+                self._slots = JobSlots(context)
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=context, initializer=_init_worker, initargs=(self._slots.stages, self._slots.cancelled)
+                )
+                self._threads = ThreadPoolExecutor(max_workers=4)
+
+    def warm(self):
+        """Starts the pool and all its workers now rather than on the first jobs, returns once they are ready"""
+        self.start()
+        self._warm = [self._pool.submit(time.sleep, 0.1) for _ in range(self.max_workers)]
+        for future in self._warm:
+            future.result()
+
+    def ready(self) -> bool:
+        return bool(self._warm) and all(future.done() for future in self._warm)
+
+    def worker_pool(self) -> ProcessPoolExecutor:
+        """The worker processes, shared with the batch conversions"""
+        with self._lock:
+            self.start()
+        return self._pool
+
+    def submit(self, svg_data: bytes, params: SVGParams, metrics: StageMetrics | None = None, session: Session | None = None) -> Job:
+        """Queues the conversion of an SVG and returns immediately, the job fills in the metrics if given"""
+        with self._lock:
+            self.start()
+            job_id = uuid.uuid4().hex
+            slot = self._slots.acquire(job_id)
+
+            key = geometry_key(svg_data, params)
+            layers = self.cache.get(key)
+            source = self.cache.get(source_key(svg_data, params)) if layers is None else None
+            if layers is not None:
+                logger.info(f"Job {job_id}: using cached paths for {key[:12]}")
+                future = self._threads.submit(self._run_cached, job_id, layers, params, metrics)
+                future.add_done_callback(lambda done: self._release(job_id))
+            else:
+                if source is not None:
+                    logger.info(f"Job {job_id}: using cached source paths")
+                    future = self._threads.submit(self._run_from_source, job_id, unpack_source(source), params, metrics, session)
+                elif params.multiLayer:
+                    future = self._threads.submit(self._run_layers, job_id, svg_data, params, metrics)
+                else:
+                    future = self._pool.submit(_run_conversion, slot, svg_data, params, metrics)
+                future.add_done_callback(lambda done: self._finish(job_id, svg_data, params, done))
+
+            job = Job(job_id, params, future, session)
+            if metrics is not None:
+                registry.increment("cache_hits" if layers is not None else "source_hits" if source is not None else "cache_misses")
+                future.add_done_callback(lambda done: self._record(job, done))
+            self._jobs[job_id] = job
+
+            # Forget the oldest finished jobs
+            excess = len(self._jobs) - self.max_jobs
+            if excess > 0:
+                finished = [old_id for old_id, old in self._jobs.items() if old.future.done()]
+                for old_id in finished[:excess]:
+                    del self._jobs[old_id]
+
+            return job
+
+    def _reporter(self, job_id: str):
+        """Stage report of the jobs run from the threads, raises JobCancelled once the job is cancelled"""
+
+        def report(stage: str):
+            with self._lock:
+                if self._slots.is_cancelled(job_id):
+                    raise JobCancelled()
+                self._slots.set_stage(job_id, stage)
+
+        return report
+
+    def _run_cached(self, job_id: str, layers: list, params: SVGParams, metrics: StageMetrics | None) -> Conversion:
+        """The paths are cached: only builds the preview data"""
+        self._reporter(job_id)("emit")
+        return Conversion(layers, build_plot_data(layers, params, metrics), metrics)
+
+    def _run_layers(self, job_id: str, svg_data: bytes, params: SVGParams, metrics: StageMetrics | None = None) -> Conversion:
+        """Multi-layer conversion, every stage runs its layers in parallel in the pool"""
+        report = self._reporter(job_id)
+
+        def stage(name: str, tasks: list, timing: str) -> list:
+            report(name)
+            futures = [self._pool.submit(*task) for task in tasks]
+            try:
+                with timed(metrics, timing):  # the stage as a whole, the per-layer stages are not broken down
+                    return [future.result() for future in futures]
+            finally:
+                for future in futures:
+                    future.cancel()
+
+        [(viewbox, raw_layers)] = stage("parse", [(read_layers, svg_data, params)], "layers_parse")
+        simplified = stage("simplify", [(simplify_layer, paths, params) for paths in raw_layers], "layers_simplify")
+        source_layers = invert_layers(simplified)
+        layers = stage("sort", [(prepare_layer, paths, viewbox, params) for paths in source_layers], "layers_sort")
+        [plot_data] = stage("emit", [(build_plot_data, layers, params)], "preview")
+        return Conversion(layers, plot_data, metrics, (viewbox, source_layers))
+
+    def _run_from_source(self, job_id: str, source: tuple, params: SVGParams, metrics: StageMetrics | None, session: Session | None) -> Conversion:
+        """Only the page changed: scales, clips and orders the cached source paths"""
+        report = self._reporter(job_id)
+        orders = session.orders_for(params) if session is not None else None
+        layers, orders = prepare_source(source, params, metrics, orders, report)
+        if session is not None:
+            session.remember_orders(params, orders)
+        report("emit")
+        return Conversion(layers, build_plot_data(layers, params, metrics), metrics)
+
+    def _release(self, job_id: str):
+        with self._lock:
+            self._slots.release(job_id)
+
+    def _finish(self, job_id: str, svg_data: bytes, params: SVGParams, future: Future):
+        self._release(job_id)
+        if not future.cancelled() and future.exception() is None:
+            conversion = future.result()
+            self.cache.put(geometry_key(svg_data, params), conversion.layers)
+            if conversion.source is not None:
+                self.cache.put(source_key(svg_data, params), pack_source(conversion.source))
+
+    def _record(self, job: Job, future: Future):
+        """Adds the metrics of a successful job to the registry"""
+        if not future.cancelled() and future.exception() is None:
+            metrics = future.result().metrics
+            metrics.timings["job"] = time.time() - job.created
+            registry.record(metrics)
+
+    def get(self, job_id: str) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def status(self, job: Job) -> dict:
+        future = job.future
+        stage = None
+        error = None
+        if future.cancelled():
+            status = "cancelled"
+        elif not future.done():
+            with self._lock:
+                stage = self._slots.stage(job.id) if self._slots is not None else None
+            status = "running" if stage or future.running() else "queued"
+        elif isinstance(future.exception(), JobCancelled):
+            status = "cancelled"
+        elif future.exception() is not None:
+            status = "failed"
+            error = str(future.exception())
+        else:
+            status = "done"
+            stage = "done"
+
+        session_id = job.session.id if job.session else None
+        return {"jobId": job.id, "sessionId": session_id, "status": status, "stage": stage, "stages": list(STAGES), "error": error}
+
+    def cancel(self, job: Job) -> bool:
+        """Cancels a job, returns False if it already finished or it is running without a slot (see JobSlots)"""
+        if job.future.done():
+            return False
+        if job.future.cancel():
+            return True
+        with self._lock:
+            return self._slots.cancel(job.id)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._threads.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
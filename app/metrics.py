@@ -0,0 +1,96 @@
+"""
+Stage timings and counters of the conversion service, served in the Prometheus text format on /metrics.
+
+Disabled unless SOFIA_METRICS=1. When disabled the pipeline gets None instead of a
+StageMetrics, timed() returns a shared no-op context and nothing is counted.
+"""
+
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+import os
+import threading
+import time
+
+ENABLED = os.environ.get("SOFIA_METRICS", "0").lower() in ("1", "true", "yes")
+
+_NO_TIMING = nullcontext()
+
+
+class StageMetrics:
+    """Timings (seconds) and counters of one request, plain data so it can be returned by a worker process"""
+
+    def __init__(self):
+        self.timings: dict[str, float] = {}
+        self.counts: dict[str, int] = {}
+
+    @contextmanager
+    def _timed(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] = self.timings.get(stage, 0.0) + time.perf_counter() - start
+
+    def count(self, name: str, value: int):
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def as_dict(self) -> dict:
+        return {"timings": {stage: round(seconds, 6) for stage, seconds in self.timings.items()}, "counts": dict(self.counts)}
+
+
+def new_metrics() -> StageMetrics | None:
+    """Metrics of a new request, None when metrics are disabled"""
+    return StageMetrics() if ENABLED else None
+
+
+def timed(metrics: StageMetrics | None, stage: str):
+    """Context adding the duration of its block to the stage timing"""
+    if metrics is None:
+        return _NO_TIMING
+    return metrics._timed(stage)
+
+
+class Registry:
+    """Totals over all requests since the start of the server"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stage_seconds = defaultdict(float)
+        self._stage_count = defaultdict(int)
+        self._counters = defaultdict(int)
+
+    def record(self, metrics: StageMetrics | None):
+        if metrics is None:
+            return
+        with self._lock:
+            for stage, seconds in metrics.timings.items():
+                self._stage_seconds[stage] += seconds
+                self._stage_count[stage] += 1
+            for name, value in metrics.counts.items():
+                self._counters[name] += value
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            self._stage_seconds[stage] += seconds
+            self._stage_count[stage] += 1
+
+    def increment(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] += value
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP sofia_stage_seconds Time spent in each stage of the conversion and upload",
+                "# TYPE sofia_stage_seconds summary",
+            ]
+            for stage in sorted(self._stage_seconds):
+                lines.append(f'sofia_stage_seconds_sum{{stage="{stage}"}} {self._stage_seconds[stage]:.6f}')
+                lines.append(f'sofia_stage_seconds_count{{stage="{stage}"}} {self._stage_count[stage]}')
+            for name in sorted(self._counters):
+                lines.append(f"# TYPE sofia_{name}_total counter")
+                lines.append(f"sofia_{name}_total {self._counters[name]}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
@@ -0,0 +1,99 @@
+"""
+Run time estimate of the G-code emitted by iter_layers_gcode.
+
+Every drawn path is a pen lift, a rapid travel to its start, a plunge and its G1 segments.
+XY moves follow a trapezoidal velocity profile with a constant acceleration. Within a path
+the speed at each corner is limited by the junction deviation, as in the Grbl/Marlin
+planners. The planner passes run as cumulative minimums over the whole buffer instead
+of one loop step per segment, so the estimate can run on every request.
+"""
+
+import numpy as np
+
+from app.pathset import PathSet, as_pathset, concat_pathsets
+
+
+def trapezoid_times(lengths, entry_sq, exit_sq, max_speed, acceleration):
+    """Times of moves accelerating from the entry speed to at most max_speed and decelerating to the exit speed (speeds squared)"""
+    max_sq = max_speed**2
+    # Distance needed to reach max_speed and to slow down again
+    ramps = (2 * max_sq - entry_sq - exit_sq) / (2 * acceleration)
+    cruise = ramps <= lengths
+    peak = np.sqrt(np.where(cruise, max_sq, np.minimum((2 * acceleration * lengths + entry_sq + exit_sq) / 2, max_sq)))
+    ramp_times = (2 * peak - np.sqrt(entry_sq) - np.sqrt(exit_sq)) / acceleration
+    return ramp_times + np.where(cruise, (lengths - ramps) / max_speed, 0.0)
+
+
+def junction_speeds_sq(directions, acceleration, junction_deviation):
+    """Squared corner speeds between consecutive unit segment directions (Grbl junction deviation)"""
+    cos_theta = -(directions[:-1] * directions[1:]).sum(axis=1)
+    sin_half = np.sqrt(np.clip(0.5 * (1 - cos_theta), 0.0, 1.0))
+    with np.errstate(divide="ignore"):
+        return np.where(sin_half < 1, acceleration * junction_deviation * sin_half / (1 - sin_half), np.inf)
+
+
+def planned_speeds_sq(lengths, limits_sq, acceleration):
+    """
+    Squared speeds at the vertices between moves, given the squared limit of each vertex.
+
+    The speed at a vertex must be reachable from every earlier vertex and must allow slowing
+    down to every later one: v[k]^2 <= limit[m] + 2a |S[k] - S[m]| with S the distance along the
+    moves. Both passes of a planner are then one running minimum, and a zero limit (a stop) ends them.
+    """
+    distance = 2 * acceleration * np.concatenate([[0.0], np.cumsum(lengths)])
+    backward = np.minimum.accumulate((limits_sq + distance)[::-1])[::-1] - distance
+    forward = np.minimum.accumulate(limits_sq - distance) + distance
+    return np.clip(np.minimum(limits_sq, np.minimum(backward, forward)), 0.0, None)
+
+
+def estimate_motion(
+    layers: list,
+    clearance: float,
+    feedrate: float,
+    travel_feedrate: float,
+    z_feedrate: float,
+    acceleration: float,
+    junction_deviation: float,
+) -> dict:
+    """
+    Drawn and travel length (mm), pen lifts, pen changes and estimated run time of layers of prepared paths.
+    Feedrates are in mm/min, the acceleration in mm/s^2 and the junction deviation in mm.
+    """
+    drawn_layers = [paths.select(paths.lengths > 1) for paths in map(as_pathset, layers)]
+    drawn_layers = [paths for paths in drawn_layers if len(paths)]
+    paths = concat_pathsets(drawn_layers) if drawn_layers else PathSet.from_arrays([])
+
+    draw_speed = feedrate / 60
+    segments = np.diff(paths.points, axis=0)
+    lengths = np.hypot(segments[:, 0], segments[:, 1])
+
+    # Segments joining the end of a path to the start of the next one are the travel moves
+    is_travel = np.zeros(len(segments), dtype=bool)
+    is_travel[paths.offsets[1:-1] - 1] = True
+    travel_lengths = lengths[is_travel]
+
+    # Drawn segments, without the zero length ones which have no direction
+    drawn = ~is_travel & (lengths > 0)
+    draw_lengths = lengths[drawn]
+    directions = segments[drawn] / draw_lengths[:, None]
+    path_ids = paths.path_ids()[:-1][drawn]
+
+    # The pen stops at both ends of a path, the speed at the corners is limited by the junction deviation
+    limits_sq = np.zeros(len(draw_lengths) + 1)
+    limits_sq[1:-1] = np.minimum(junction_speeds_sq(directions, acceleration, junction_deviation), draw_speed**2)
+    limits_sq[1:-1][path_ids[:-1] != path_ids[1:]] = 0.0
+    speeds_sq = planned_speeds_sq(draw_lengths, limits_sq, acceleration)
+    draw_time = trapezoid_times(draw_lengths, speeds_sq[:-1], speeds_sq[1:], draw_speed, acceleration).sum()
+
+    # Travel moves and pen moves start and end at rest
+    travel_time = trapezoid_times(travel_lengths, 0.0, 0.0, travel_feedrate / 60, acceleration).sum()
+    z_speed = min(feedrate, z_feedrate) / 60
+    pen_time = 2 * len(paths) * trapezoid_times(np.float64(abs(clearance)), 0.0, 0.0, z_speed, acceleration)
+
+    return {
+        "drawnLength": float(draw_lengths.sum()),
+        "travelLength": float(travel_lengths.sum()),
+        "penLifts": len(paths),
+        "penChanges": max(len(drawn_layers) - 1, 0),
+        "estimatedTimeMinutes": float(draw_time + travel_time + pen_time) / 60,
+    }
@@ -0,0 +1,94 @@
+import numpy as np
+
+
+class PathSet:
+    """
+    Paths stored as one (N, 2) float64 coordinate buffer and an int64 offsets array (CSR layout):
+    path i is points[offsets[i]:offsets[i + 1]].
+
+    Operations work on the whole buffer at once, indexing or iterating gives (N, 2) views.
+    """
+
+    def __init__(self, points: np.ndarray, offsets: np.ndarray):
+        self.points = points
+        self.offsets = offsets
+
+    @classmethod
+    def from_arrays(cls, paths) -> "PathSet":
+        """PathSet of a list of (N, 2) arrays (or nested lists)"""
+        paths = [np.asarray(path, dtype=float).reshape(-1, 2) for path in paths]
+        points = np.concatenate(paths) if paths else np.empty((0, 2))
+        offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in paths], out=offsets[1:])
+        return cls(points, offsets)
+
+    @classmethod
+    def from_lengths(cls, points: np.ndarray, lengths) -> "PathSet":
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(points, offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> np.ndarray:
+        return self.points[self.offsets[i] : self.offsets[i + 1]]
+
+    def __iter__(self):
+        return iter(self.to_arrays())
+
+    def to_arrays(self) -> list:
+        """The paths as a list of views into the buffer"""
+        return np.split(self.points, self.offsets[1:-1]) if len(self) else []
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def nbytes(self) -> int:
+        return self.points.nbytes + self.offsets.nbytes
+
+    def path_ids(self) -> np.ndarray:
+        """Index of the path of every point"""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def starts(self) -> np.ndarray:
+        return self.points[self.offsets[:-1]]
+
+    def ends(self) -> np.ndarray:
+        return self.points[self.offsets[1:] - 1]
+
+    def take(self, order, reverse=None) -> "PathSet":
+        """The paths in the given order, reversed where reverse is set, gathered into a new buffer"""
+        order = np.asarray(order, dtype=np.intp)
+        lengths = self.lengths[order]
+        offsets = np.zeros(len(order) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+
+        # Position of every output point within its path, and the start of its path in this buffer
+        within = np.arange(offsets[-1]) - np.repeat(offsets[:-1], lengths)
+        source = np.repeat(self.offsets[:-1][order], lengths)
+        if reverse is not None:
+            flipped = np.repeat(np.asarray(reverse, dtype=bool), lengths)
+            within = np.where(flipped, np.repeat(lengths, lengths) - 1 - within, within)
+        return PathSet(self.points[source + within], offsets)
+
+    def select(self, mask) -> "PathSet":
+        """The paths where mask is set, in order"""
+        mask = np.asarray(mask, dtype=bool)
+        if mask.all():
+            return self
+        return PathSet(self.points[np.repeat(mask, self.lengths)], np.concatenate([[0], np.cumsum(self.lengths[mask])]).astype(np.int64))
+
+
+def as_pathset(paths) -> PathSet:
+    return paths if isinstance(paths, PathSet) else PathSet.from_arrays(paths)
+
+
+def concat_pathsets(pathsets: list) -> PathSet:
+    """One PathSet holding the paths of all the given ones, in order"""
+    if len(pathsets) == 1:
+        return pathsets[0]
+    points = np.concatenate([paths.points for paths in pathsets]) if pathsets else np.empty((0, 2))
+    return PathSet.from_lengths(points, np.concatenate([paths.lengths for paths in pathsets]) if pathsets else [])
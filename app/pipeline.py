@@ -0,0 +1,373 @@
+from pydantic import BaseModel, Field
+from typing import Callable, Literal, NamedTuple
+import logging
+import math
+import numpy as np
+
+from app.utils import prepare_paths, adaptive_simplify, clip_paths, path_order, apply_path_order, merge_paths, plot_moves, paths_total_length, pack_preview, preprocess_svg, truncate_decimals
+from app.cache import cache_key
+from app.pathset import PathSet, as_pathset, concat_pathsets
+from app.motion import estimate_motion
+from app.preview import PreviewPyramid
+from app.metrics import StageMetrics, timed
+
+# vpype (app.vpype_convert) is only imported where it is used, it is slow to import
+# and the API process doesn't need it to start answering (see warm_worker)
+
+logger = logging.getLogger(__name__)
+
+# Stages reported while converting an SVG, in order
+STAGES = ("parse", "simplify", "sort", "emit")
+
+
+class SVGParams(BaseModel):
+    width: float
+    height: float
+    outputFile: str
+    polylineTolerance: float
+    clearance: float
+    optimize: bool
+    optimizeTimeBudget: float = 0.0  # seconds of 2-opt improvement after the greedy ordering
+    mergeTolerance: float = 0.0  # mm, consecutive paths closer than this are drawn without lifting the pen
+    feedrate: int = Field(gt=0)
+    flipVertically: bool
+    flipHorizontally: bool
+    previewFormat: Literal["json", "float32", "uint16", "tiles"] = "json"  # see pack_preview for the packed formats, preview.py for tiles
+    multiLayer: bool = False  # keep the SVG layers, each one is plotted with its own pen
+    penChangeCommand: str = "M226"  # pauses the job between layers
+    simplifyTolerance: float = 0.0  # mm, replaces polylineTolerance: paths are read at this resolution and simplified after scaling
+    arcTolerance: float = 0.0  # mm, runs of points this close to a circle are drawn as G2/G3 arcs (0 for G1 moves only)
+    # Motion model of the plotter for the time estimate (see motion.estimate_motion)
+    travelFeedrate: int = Field(12000, gt=0)  # mm/min of the G0 travel moves
+    zFeedrate: int = Field(3000, gt=0)  # mm/min of the pen lifts
+    acceleration: float = Field(1000.0, gt=0)  # mm/s^2
+    junctionDeviation: float = Field(0.05, ge=0)  # mm
+
+
+class Conversion(NamedTuple):
+    """Result of a conversion job"""
+
+    layers: list  # prepared paths of each layer (see iter_layers_gcode)
+    plot_data: dict
+    metrics: StageMetrics | None = None
+    source: tuple | None = None  # (viewBox, paths of each layer) before scaling, when the SVG was read (see prepare_source)
+
+
+class JobCancelled(Exception):
+    """Raised from a stage report when the conversion has been cancelled"""
+
+
+def _no_report(stage: str):
+    pass
+
+
+def geometry_key(svg_data: bytes, params: SVGParams) -> str:
+    """Cache key of the processed paths, only the G-code emission depends on the motion parameters (clearance, feedrate)"""
+    return cache_key(
+        svg_data,
+        polylineTolerance=params.polylineTolerance,
+        optimize=params.optimize,
+        optimizeTimeBudget=params.optimizeTimeBudget,
+        mergeTolerance=params.mergeTolerance,
+        simplifyTolerance=params.simplifyTolerance,
+        width=params.width,
+        height=params.height,
+        flipVertically=params.flipVertically,
+        flipHorizontally=params.flipHorizontally,
+        multiLayer=params.multiLayer,
+    )
+
+
+def source_key(svg_data: bytes, params: SVGParams) -> str:
+    """Cache key of the source paths, they only depend on how the SVG is read and simplified"""
+    # With a simplifyTolerance the SVG is read at a resolution that depends on the page size (see read_tolerances)
+    page = {"width": params.width, "height": params.height} if params.simplifyTolerance > 0 else {}
+    return cache_key(
+        svg_data,
+        source=True,
+        polylineTolerance=params.polylineTolerance,
+        simplifyTolerance=params.simplifyTolerance,
+        optimize=params.optimize,
+        multiLayer=params.multiLayer,
+        **page,
+    )
+
+
+def read_tolerances(viewbox: tuple, params: SVGParams) -> tuple[float, float]:
+    """
+    linesimplify tolerance and curve quantization (in SVG units) of the paths read from the SVG.
+    With a simplifyTolerance (mm) the paths are simplified after scaling (see adaptive_simplify) and
+    the curves are split into segments of 4 * simplifyTolerance on the page: their chords stay within
+    half the tolerance of any curve of radius 4 * simplifyTolerance or more.
+    Otherwise polylineTolerance applies in SVG units.
+    """
+    from app.vpype_convert import DEFAULT_QUANTIZATION
+
+    if params.simplifyTolerance <= 0:
+        return params.polylineTolerance, DEFAULT_QUANTIZATION
+    scale = max(params.width / viewbox[2], params.height / viewbox[3])
+    return 0.0, 4 * params.simplifyTolerance / scale
+
+
+def pack_source(source: tuple) -> list:
+    """Source as layers of paths for the path cache, the viewBox is stored as an extra first layer"""
+    viewbox, layers = source
+    return [PathSet.from_lengths(np.reshape(viewbox, (2, 2)).astype(float), [2]), *layers]
+
+
+def unpack_source(entry: list) -> tuple:
+    viewbox, *layers = entry
+    return tuple(viewbox.points.ravel().tolist()), layers
+
+
+def transform_paths(paths: PathSet, viewbox: tuple, params: SVGParams) -> PathSet:
+    """Scales paths from the SVG viewBox to the page (in mm) and applies the flips"""
+    paths = as_pathset(paths)
+    vb_min_x, vb_min_y, vb_width, vb_height = viewbox
+
+    # Calculate scaling factors
+    scale_x = params.width / vb_width
+    scale_y = params.height / vb_height
+
+    # Scale all the points at once
+    scaled = np.empty_like(paths.points)
+    scaled[:, 0] = (paths.points[:, 0] - vb_min_x) * scale_x
+    scaled[:, 1] = (paths.points[:, 1] - vb_min_y) * scale_y
+
+    # Apply flipping if needed
+    if params.flipVertically:
+        scaled[:, 1] = params.height - scaled[:, 1]
+
+    if params.flipHorizontally:
+        scaled[:, 0] = params.width - scaled[:, 0]
+
+    return PathSet(scaled, paths.offsets)
+
+
+def count_paths(metrics: StageMetrics | None, prefix: str, paths: PathSet):
+    if metrics is not None:
+        metrics.count(f"{prefix}_paths", len(paths))
+        metrics.count(f"{prefix}_points", len(paths.points))
+
+
+def process_geometry(svg_data: bytes, params: SVGParams, report: Callable[[str], None] = _no_report, metrics: StageMetrics | None = None) -> tuple[list, tuple]:
+    """Runs the SVG through vpype as a single layer, scales it to the page and clips/orders the paths
+
+    Returns a list holding the one layer of prepared paths and the source (see prepare_source)
+    """
+
+    # Extract viewbox information and strip the units, the document is parsed once here and once by vpype
+    report("parse")
+    with timed(metrics, "preprocess"):
+        viewbox, svg_data_stripped = preprocess_svg(svg_data)
+        logger.debug(f"viewbox: {viewbox}")
+
+    report("simplify")
+    with timed(metrics, "vpype"):
+        from app.vpype_convert import process_svg_string_to_arrays
+
+        tolerance, quantization = read_tolerances(viewbox, params)
+        paths_by_layer = process_svg_string_to_arrays(
+            svg_data_stripped,
+            single_layer=True,
+            tolerance=tolerance,
+            optimize=params.optimize,
+            quantization=quantization,
+        )
+
+    # Single layer mode, there is at most one layer
+    paths_numpy_array = paths_by_layer[0] if paths_by_layer else PathSet.from_arrays([])
+    count_paths(metrics, "input", paths_numpy_array)
+
+    report("sort")
+    with timed(metrics, "scaling"):
+        scaled_paths = transform_paths(paths_numpy_array, viewbox, params)
+    paths = prepare_paths(
+        scaled_paths,
+        size=(params.width, params.height),
+        optimize=params.optimize,
+        optimize_time_budget=params.optimizeTimeBudget,
+        merge_tolerance=params.mergeTolerance,
+        simplify_tolerance=params.simplifyTolerance,
+        metrics=metrics,
+    )
+    count_paths(metrics, "output", paths)
+    return [paths], (viewbox, [paths_numpy_array])
+
+
+# Converted by every worker when it starts: the first job doesn't pay for the lazy imports and first calls (curves, circles)
+WARM_UP_SVG = b'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 10 10"><path d="M1 1 L9 1 C9 9 1 9 1 1"/><circle cx="5" cy="5" r="2"/></svg>'
+
+
+def warm_worker():
+    """Initializer of the worker processes: vpype is imported, its config loaded and a small drawing converted before the first job"""
+    from app.vpype_convert import load_config
+
+    load_config()
+    params = SVGParams(
+        width=10, height=10, outputFile="warm-up", polylineTolerance=0.1, clearance=1, optimize=False, feedrate=1000, flipVertically=False, flipHorizontally=False
+    )
+    convert_svg(WARM_UP_SVG, params)
+
+
+# The stages of a multi-layer conversion, the layers of each stage run in parallel (see JobManager)
+
+
+def read_layers(svg_data: bytes, params: SVGParams) -> tuple[tuple, list]:
+    """parse stage: viewBox and raw paths of every SVG layer"""
+    from app.vpype_convert import read_svg_layers
+
+    viewbox, svg_data_stripped = preprocess_svg(svg_data)
+    _, quantization = read_tolerances(viewbox, params)
+    return viewbox, read_svg_layers(svg_data_stripped, quantization)
+
+
+def simplify_layer(paths: PathSet, params: SVGParams) -> PathSet:
+    """simplify stage of one layer"""
+    from app.vpype_convert import simplify_paths
+
+    tolerance = params.polylineTolerance if params.simplifyTolerance <= 0 else 0.0
+    return simplify_paths(paths, tolerance=tolerance, optimize=params.optimize)
+
+
+def invert_layers(layers: list) -> list:
+    """Inverts the y axis of the simplified layers around the drawing center (see vpype_convert.bounds_center_y), the result is the source"""
+    from app.vpype_convert import bounds_center_y, invert_y
+
+    center_y = bounds_center_y(layers)
+    return [invert_y(paths, center_y) for paths in layers]
+
+
+def prepare_layer(paths: PathSet, viewbox: tuple, params: SVGParams) -> PathSet:
+    """sort stage of one source layer: scales, clips and orders"""
+    scaled_paths = transform_paths(paths, viewbox, params)
+    return prepare_paths(
+        scaled_paths,
+        size=(params.width, params.height),
+        optimize=params.optimize,
+        optimize_time_budget=params.optimizeTimeBudget,
+        merge_tolerance=params.mergeTolerance,
+        simplify_tolerance=params.simplifyTolerance,
+    )
+
+
+# Updates from the source paths, used when only the page or the motion parameters changed
+
+
+def reusable_orders(previous: SVGParams, params: SVGParams) -> bool:
+    """
+    Whether the path orders of the previous parameters still apply: when the page is only scaled
+    uniformly all distances scale alike, clipping cuts the same pieces and the greedy order is the same.
+    A flip moves the drawing relative to the origin the greedy order starts from, so it is recomputed.
+    """
+    return (
+        params.optimize
+        and previous.polylineTolerance == params.polylineTolerance
+        and previous.simplifyTolerance == params.simplifyTolerance
+        and previous.optimize == params.optimize
+        and previous.multiLayer == params.multiLayer
+        and previous.optimizeTimeBudget == params.optimizeTimeBudget
+        and previous.flipVertically == params.flipVertically
+        and previous.flipHorizontally == params.flipHorizontally
+        and math.isclose(previous.width * params.height, params.width * previous.height, rel_tol=1e-12)
+    )
+
+
+def prepare_source(
+    source: tuple, params: SVGParams, metrics: StageMetrics | None = None, orders: list | None = None, report: Callable[[str], None] = _no_report
+) -> tuple[list, list]:
+    """
+    Scales, simplifies, clips, orders and merges the source paths of every layer, as the full conversion does.
+
+    orders are the (order, reverse) of each layer from a previous call (see reusable_orders), they
+    replace the ordering when a layer still has as many paths. The "sort" stage is reported before
+    every layer. Returns the layers and their orders.
+    """
+    viewbox, source_layers = source
+    layers = []
+    new_orders = []
+    for i, paths in enumerate(source_layers):
+        report("sort")
+        with timed(metrics, "scaling"):
+            scaled_paths = transform_paths(paths, viewbox, params)
+        if params.simplifyTolerance > 0:
+            with timed(metrics, "simplify"):
+                scaled_paths = adaptive_simplify(scaled_paths, params.simplifyTolerance)
+        with timed(metrics, "clip"):
+            paths = clip_paths(scaled_paths, (params.width, params.height))
+
+        order = None
+        if params.optimize and len(paths) > 1:
+            if orders and orders[i] is not None and len(orders[i][0]) == len(paths):
+                order = orders[i]
+            else:
+                with timed(metrics, "optimize"):
+                    order = path_order(paths, params.optimizeTimeBudget)
+            paths = apply_path_order(paths, *order)
+        if params.mergeTolerance > 0:
+            with timed(metrics, "merge"):
+                paths = merge_paths(paths, params.mergeTolerance)
+
+        layers.append(paths)
+        new_orders.append(order)
+    return layers, new_orders
+
+
+def build_plot_data(layers: list, params: SVGParams, metrics: StageMetrics | None = None) -> dict:
+    """Preview data sent back to the frontend with the G-code, the layers are shown as one drawing"""
+    with timed(metrics, "preview"):
+        plot_data = _build_plot_data(layers, params)
+    with timed(metrics, "estimate"):
+        plot_data.update(motion_estimate(layers, params))
+    return plot_data
+
+
+def motion_estimate(layers: list, params: SVGParams) -> dict:
+    return estimate_motion(
+        layers,
+        clearance=params.clearance,
+        feedrate=params.feedrate,
+        travel_feedrate=params.travelFeedrate,
+        z_feedrate=params.zFeedrate,
+        acceleration=params.acceleration,
+        junction_deviation=params.junctionDeviation,
+    )
+
+
+def _build_plot_data(layers: list, params: SVGParams) -> dict:
+    paths = concat_pathsets([as_pathset(layer) for layer in layers])
+    if params.previewFormat == "tiles":
+        # The overview tile, the frontend requests the others from /jobs/{job_id}/preview
+        pyramid = PreviewPyramid(layers, (params.width, params.height))
+        return {"preview": pyramid.tile(0, 0, 0), "tiles": pyramid.describe(), "totalLength": paths_total_length(paths)}
+
+    if params.previewFormat == "json":
+        regular_moves, travel_moves, total_length = plot_moves(paths)
+        return {
+            "regularMoves": truncate_decimals(regular_moves),
+            "travelMoves": truncate_decimals(travel_moves),
+            "totalLength": total_length,
+        }
+
+    return {
+        "preview": pack_preview(paths, (params.width, params.height), params.previewFormat),
+        "totalLength": paths_total_length(paths),
+    }
+
+
+def convert_svg(svg_data: bytes, params: SVGParams, report: Callable[[str], None] = _no_report, metrics: StageMetrics | None = None) -> Conversion:
+    """Single layer conversion of an SVG"""
+    layers, source = process_geometry(svg_data, params, report, metrics)
+    report("emit")
+    return Conversion(layers, build_plot_data(layers, params, metrics), metrics, source)
+
+
+def convert_svg_layers(svg_data: bytes, params: SVGParams, metrics: StageMetrics | None = None) -> Conversion:
+    """Multi-layer conversion of an SVG in the calling process (the JobManager runs the layers of each stage in parallel)"""
+    with timed(metrics, "layers_parse"):
+        viewbox, raw_layers = read_layers(svg_data, params)
+    with timed(metrics, "layers_simplify"):
+        source_layers = invert_layers([simplify_layer(paths, params) for paths in raw_layers])
+    with timed(metrics, "layers_sort"):
+        layers = [prepare_layer(paths, viewbox, params) for paths in source_layers]
+    return Conversion(layers, build_plot_data(layers, params, metrics), metrics, (viewbox, source_layers))
@@ -0,0 +1,200 @@
+"""
+Stand-in for the Duet (DSF) REST API of the plotter, enough of it to exercise gcode_sender without a machine.
+
+    uv run python -m app.plotter_stub --port 8081 --session-ttl 30
+    SOFIA_PLOTTER_HOST=localhost:8081 uv run python main.py
+
+Several of them on different ports stand in for a fleet (SOFIA_PLOTTERS="a=localhost:8081,b=localhost:8082").
+
+Uploaded files are kept in memory (or written under --directory). --fail-uploads and
+--drop-every make uploads fail (503) or lose their connection on purpose.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit, parse_qs
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+
+
+class PlotterStub:
+    """File store and session keys of the stand-in plotter"""
+
+    def __init__(
+        self, directory: str | None = None, session_ttl: float | None = None, upload_delay: float = 0.0, fail_uploads: int = 0, drop_every: int = 0
+    ):
+        self.files: dict[str, bytes] = {}
+        self.directory = directory
+        self.session_ttl = session_ttl
+        self.upload_delay = upload_delay  # seconds every upload takes
+        self.fail_uploads = fail_uploads  # the next uploads answered with a 503
+        self.drop_every = drop_every  # the connection of every drop_every-th upload is closed before its body is read
+        self.uploads = 0
+        self.sessions: dict[str, float] = {}
+        self.requests: list[tuple[str, str]] = []  # (method, path) of every request, for inspection
+        self.lock = threading.Lock()
+
+    def connect(self) -> str:
+        key = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[key] = time.time()
+        return key
+
+    def valid(self, key: str | None) -> bool:
+        with self.lock:
+            created = self.sessions.get(key)
+        return created is not None and (self.session_ttl is None or time.time() - created < self.session_ttl)
+
+    def expire_sessions(self):
+        with self.lock:
+            self.sessions.clear()
+
+    def failing(self) -> bool:
+        """Whether this upload should fail (counts down fail_uploads)"""
+        with self.lock:
+            if self.fail_uploads <= 0:
+                return False
+            self.fail_uploads -= 1
+            return True
+
+    def dropping(self) -> bool:
+        """Whether this upload should lose its connection (counts the uploads)"""
+        with self.lock:
+            self.uploads += 1
+            return self.drop_every > 0 and self.uploads % self.drop_every == 0
+
+    def put(self, path: str, data: bytes):
+        with self.lock:
+            self.files[path] = data
+        if self.directory:
+            file_path = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, "wb") as f:
+                f.write(data)
+
+    def move(self, source: str, target: str):
+        with self.lock:
+            data = self.files.pop(source)
+        if self.directory:
+            source_path = os.path.join(self.directory, source)
+            if os.path.exists(source_path):
+                os.remove(source_path)
+        self.put(target, data)
+
+    def listing(self, directory: str) -> list[dict]:
+        directory = directory.strip("/")
+        with self.lock:
+            return [
+                {"type": "f", "name": path.rsplit("/", 1)[-1], "size": len(data)}
+                for path, data in self.files.items()
+                if path.rsplit("/", 1)[0] == directory
+            ]
+
+
+def make_handler(stub: PlotterStub):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+
+        def send(self, status: int, body=None):
+            data = json.dumps(body).encode() if body is not None else b""
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_body(self) -> bytes:
+            if self.headers.get("Transfer-Encoding") == "chunked":
+                data = bytearray()
+                while True:
+                    size = int(self.rfile.readline().split(b";")[0].strip(), 16)
+                    if size == 0:
+                        self.rfile.readline()
+                        return bytes(data)
+                    data += self.rfile.read(size)
+                    self.rfile.readline()
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def route(self, method: str):
+            url = urlsplit(self.path)
+            path = unquote(url.path)
+            stub.requests.append((method, path))
+
+            if method == "PUT" and path.startswith("/machine/file/") and stub.dropping():
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+
+            # Read the body first so the connection stays usable whatever the answer is
+            body = self.read_body() if method in ("PUT", "POST") else b""
+
+            if method == "GET" and path == "/machine/connect":
+                return self.send(200, {"sessionKey": stub.connect()})
+            if not stub.valid(self.headers.get("X-Session-Key")):
+                return self.send(401)
+
+            if method == "GET" and path.startswith("/machine/directory/"):
+                return self.send(200, stub.listing(path[len("/machine/directory/"):]))
+            if method == "GET" and path.startswith("/machine/fileinfo/"):
+                name = path[len("/machine/fileinfo/"):]
+                if name not in stub.files:
+                    return self.send(404)
+                return self.send(200, {"fileName": name, "size": len(stub.files[name])})
+            if method == "PUT" and path.startswith("/machine/file/"):
+                time.sleep(stub.upload_delay)
+                if stub.failing():
+                    return self.send(503)
+                stub.put(path[len("/machine/file/"):], body)
+                return self.send(201)
+            if method == "POST" and path == "/machine/file/move":
+                form = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+                source, target = form.get("from"), form.get("to")
+                if source not in stub.files:
+                    return self.send(404)
+                if target in stub.files and form.get("force", "false") != "true":
+                    return self.send(500)
+                stub.move(source, target)
+                return self.send(204)
+            self.send(404)
+
+        def do_GET(self):
+            self.route("GET")
+
+        def do_PUT(self):
+            self.route("PUT")
+
+        def do_POST(self):
+            self.route("POST")
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(stub: PlotterStub, host: str = "127.0.0.1", port: int = 8081) -> ThreadingHTTPServer:
+    """Starts the stand-in in a background thread, returns the server (call shutdown() to stop it)"""
+    server = ThreadingHTTPServer((host, port), make_handler(stub))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--directory", help="also write the uploaded files here")
+    parser.add_argument("--session-ttl", type=float, help="seconds before session keys expire (401)")
+    parser.add_argument("--upload-delay", type=float, default=0.0, help="seconds every upload takes")
+    parser.add_argument("--fail-uploads", type=int, default=0, help="answer the first uploads with a 503")
+    parser.add_argument("--drop-every", type=int, default=0, help="close the connection of every n-th upload")
+    args = parser.parse_args()
+
+    stub = PlotterStub(args.directory, args.session_ttl, upload_delay=args.upload_delay, fail_uploads=args.fail_uploads, drop_every=args.drop_every)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(stub))
+    print(f"Plotter stand-in listening on {args.host}:{args.port}")
+    server.serve_forever()
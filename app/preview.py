@@ -0,0 +1,146 @@
+"""
+Multi-resolution preview of large drawings, so the frontend only loads what it shows.
+
+Level k of the pyramid covers the page with square tiles of max(width, height) / 2**k mm
+drawn at TILE_PIXELS pixels: the paths are simplified to half a pixel, the points on the
+pixel of the previous point are dropped and the 2 point paths are kept once per pair of
+pixels, so dense areas cost at most what their pixels do. The levels go down to the G-code
+resolution. Level 0 is a single tile, the overview sent with the conversion result whatever
+the size of the drawing, the other tiles are cut on demand (see PreviewPyramid.viewport).
+"""
+
+from collections import OrderedDict
+import math
+import threading
+
+import numpy as np
+
+from app.pathset import PathSet, as_pathset, concat_pathsets
+from app.utils import DEFAULT_PRECISION, adaptive_simplify, clip_paths, pack_preview
+
+TILE_PIXELS = 256
+
+
+def travel_moves(paths: PathSet) -> PathSet:
+    """Travel moves from the end of each path to the start of the next one, as 2 point paths"""
+    moves = np.stack([paths.ends()[:-1], paths.starts()[1:]], axis=1).reshape(-1, 2)
+    return PathSet.from_lengths(moves, np.full(max(len(paths) - 1, 0), 2))
+
+
+def pixel_decimate(paths: PathSet, pixel: float) -> PathSet:
+    """Drops the points on the pixel of the previous point (path ends are kept) and the 2 point paths repeating another one on the pixel grid"""
+    if len(paths.points) == 0:
+        return paths
+    cells = np.floor(paths.points / pixel).astype(np.int64)
+    path_ids = paths.path_ids()
+
+    keep = np.ones(len(cells), dtype=bool)
+    keep[1:] = (cells[1:] != cells[:-1]).any(axis=1) | (path_ids[1:] != path_ids[:-1])
+    keep[paths.offsets[1:] - 1] = True
+    removed = np.concatenate([[0], np.cumsum(~keep)])
+    paths = PathSet(paths.points[keep], paths.offsets - removed[paths.offsets])
+    cells = cells[keep]
+
+    # Paths left with 2 points look the same when they join the same 2 pixels, one of them is enough
+    segments = np.flatnonzero(paths.lengths <= 2)
+    a, b = cells[paths.offsets[:-1]][segments], cells[paths.offsets[1:] - 1][segments]
+    swap = ((a[:, 0] > b[:, 0]) | ((a[:, 0] == b[:, 0]) & (a[:, 1] > b[:, 1])))[:, None]
+    _, first = np.unique(np.hstack([np.where(swap, b, a), np.where(swap, a, b)]), axis=0, return_index=True)
+    repeated = np.ones(len(paths), dtype=bool)
+    repeated[segments] = False
+    repeated[segments[first]] = True
+    return paths.select(repeated)
+
+
+def bounding_boxes(paths: PathSet) -> tuple[np.ndarray, np.ndarray]:
+    """(min, max) corners of every path, paths must have points"""
+    if not len(paths):
+        return np.empty((0, 2)), np.empty((0, 2))
+    return np.minimum.reduceat(paths.points, paths.offsets[:-1]), np.maximum.reduceat(paths.points, paths.offsets[:-1])
+
+
+class PreviewPyramid:
+    """Levels of detail of prepared layers, cut into tiles (see the module docstring)"""
+
+    def __init__(self, layers: list, size: tuple[float, float], tile_pixels: int = TILE_PIXELS, max_tiles: int = 256):
+        paths = concat_pathsets([as_pathset(layer) for layer in layers]) if layers else PathSet.from_arrays([])
+        self.drawn = paths.select(paths.lengths > 1)
+        self.size = size
+        self.tile_pixels = tile_pixels
+        self.extent = max(max(size), 1e-9)
+        # The finest level has pixels of the G-code resolution
+        self.max_level = max(math.ceil(math.log2(self.extent / (tile_pixels * 10**-DEFAULT_PRECISION))), 0)
+
+        self.max_tiles = max_tiles
+        self._levels: dict[int, tuple] = {}
+        self._tiles: OrderedDict[tuple, dict] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def describe(self) -> dict:
+        return {"tilePixels": self.tile_pixels, "maxLevel": self.max_level, "extent": self.extent, "size": list(self.size)}
+
+    def tile_size(self, level: int) -> float:
+        return self.extent / 2**level
+
+    def pixel(self, level: int) -> float:
+        return self.tile_size(level) / self.tile_pixels
+
+    def level(self, level: int) -> tuple:
+        """Decimated drawn paths and travel moves of a level, with their bounding boxes"""
+        with self._lock:
+            if level not in self._levels:
+                pixel = self.pixel(level)
+                regular = pixel_decimate(adaptive_simplify(self.drawn, pixel / 2), pixel)
+                travel = travel_moves(self.drawn)
+                travel = travel.select(np.hypot(*(travel.ends() - travel.starts()).T) >= pixel)
+                self._levels[level] = (regular, *bounding_boxes(regular), travel, *bounding_boxes(travel))
+            return self._levels[level]
+
+    def tile(self, level: int, x: int, y: int) -> dict:
+        """
+        Drawn paths and travel moves of a tile clipped to it, packed as uint16 previews (see pack_preview)
+        relative to the origin of the tile. The travel moves are explicit, not implied between the paths.
+        """
+        key = (level, x, y)
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                return self._tiles[key]
+
+        size = self.tile_size(level)
+        origin = np.array([x, y]) * size
+        regular, regular_min, regular_max, travel, travel_min, travel_max = self.level(level)
+        tile = {
+            "level": level,
+            "x": x,
+            "y": y,
+            "origin": origin.tolist(),
+            "size": size,
+            "regular": self._cut(regular, regular_min, regular_max, origin, size),
+            "travel": self._cut(travel, travel_min, travel_max, origin, size),
+        }
+
+        with self._lock:
+            self._tiles[key] = tile
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return tile
+
+    def _cut(self, paths: PathSet, mins: np.ndarray, maxs: np.ndarray, origin: np.ndarray, size: float) -> dict:
+        inside = (maxs >= origin).all(axis=1) & (mins <= origin + size).all(axis=1)
+        paths = paths.select(inside)
+        return pack_preview(clip_paths(PathSet(paths.points - origin, paths.offsets), (size, size)), (size, size), "uint16")
+
+    def viewport(self, x0: float, y0: float, x1: float, y1: float, pixels: int, level: int | None = None) -> dict:
+        """Tiles covering the (x0, y0) - (x1, y1) rectangle (mm), at the coarsest level with pixels across it or at the given level"""
+        if level is None:
+            pixel = max(x1 - x0, y1 - y0) / max(pixels, 1)
+            level = math.ceil(math.log2(self.extent / (self.tile_pixels * pixel))) if pixel > 0 else self.max_level
+        level = min(max(level, 0), self.max_level)
+
+        size = self.tile_size(level)
+        columns = max(math.ceil(self.size[0] / size), 1)
+        rows = max(math.ceil(self.size[1] / size), 1)
+        xs = range(max(math.floor(x0 / size), 0), min(math.floor(x1 / size), columns - 1) + 1)
+        ys = range(max(math.floor(y0 / size), 0), min(math.floor(y1 / size), rows - 1) + 1)
+        return {"level": level, "tileSize": size, "tiles": [self.tile(level, x, y) for y in ys for x in xs]}
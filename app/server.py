@@ -1,24 +1,74 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
+import asyncio
 import base64
-import numpy as np
+import json
+import os
+from functools import partial
+import threading
 import traceback
-from svgpathtools import svg2paths2, paths2Drawing
-from io import StringIO
-from devtools import debug as d
+import time
+import zipfile
+
+from app.utils import iter_layers_gcode, iter_chunks, iter_base64
+from app.gcode_sender import upload_error
+from app.pipeline import SVGParams
+from app.cache import PathCache
+from app.jobs import Job, JobManager
+from app.sessions import SessionStore
+from app.batch import convert_archive
+from app.dispatch import Dispatcher, plotters_from_env
+from app import metrics
+
+STARTED = time.time()
+
+# Processed paths of recent requests, keyed by the SVG content and the parameters affecting the geometry
+path_cache = PathCache(
+    max_bytes=int(os.environ.get("SOFIA_CACHE_MB", 256)) * 2**20,
+    directory=os.environ.get("SOFIA_CACHE_DIR"),
+)
+
+# Every request's SVG is written there when set
+debug_svg_path = os.environ.get("SOFIA_DEBUG_SVG")
+
+# Conversions run in worker processes so the event loop stays responsive
+jobs = JobManager(path_cache, max_workers=int(os.environ.get("SOFIA_WORKERS", 0)) or None)
+
+# Last upload of each client, later requests can send only the parameters that changed
+sessions = SessionStore(max_sessions=int(os.environ.get("SOFIA_SESSIONS", 16)))
+
+# Plotters of SOFIA_PLOTTERS (see dispatch.plotters_from_env), uploads are retried with a backoff
+# and resumed from the last part on the plotter when SOFIA_UPLOAD_PART_BYTES is set
+dispatcher = Dispatcher(
+    plotters_from_env(),
+    max_attempts=int(os.environ.get("SOFIA_UPLOAD_ATTEMPTS", 4)),
+    backoff=float(os.environ.get("SOFIA_UPLOAD_BACKOFF", 1.0)),
+    part_size=int(os.environ.get("SOFIA_UPLOAD_PART_BYTES", 0)),
+)
+
+
+def warm_up():
+    start = time.perf_counter()
+    jobs.warm()
+    # The coordinator of multi-layer jobs and the cache hits run in this process
+    import app.vpype_convert
 
-from app.utils import create_gcode, extract_viewbox, truncate_decimals, strip_svg_units
-from app.gcode_sender import send_gcode, set_gcode_data
-from app.vpype_convert import process_svg_string_to_json
+    print(f"Workers ready in {time.perf_counter() - start:.2f}s")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Lifespan context manager to load functions and types from the provided path argument"""
     print("Starting Sofia Plotter")
+    # The workers import the geometry modules in the background, /health answers meanwhile
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    dispatcher.start()
     yield
+    dispatcher.stop()
+    jobs.shutdown()
 
 
 # Create the FastAPI app
@@ -38,113 +88,280 @@ app.add_middleware(
 )
 
 
-class SVGParams(BaseModel):
-    width: float
-    height: float
-    outputFile: str
-    polylineTolerance: float
-    clearance: float
-    optimize: bool
-    feedrate: int
-    flipVertically: bool
-    flipHorizontally: bool
-
-
 class SVGData(BaseModel):
     svg_base64: str
     params: SVGParams
 
 
+class SessionUpdate(BaseModel):
+    params: dict  # the SVGParams fields that changed
+
+
 class SendGCodeRequest(BaseModel):
-    hostname: str
+    hostname: str = ""  # unused, the plotters are configured on the server (SOFIA_PLOTTERS)
+    jobId: str | None = None  # default: the last G-code of the session, or the last one of any session
+    sessionId: str | None = None
+    plotter: str | None = None  # default: the first idle plotter
+    wait: bool = True  # answer once uploaded, otherwise right away with the dispatch status
+
+
+def gcode_blocks(job: Job):
+    """The G-code of a finished job, as a callable returning a fresh iterator over its text blocks"""
+    layers = job.result.layers
+    params = job.params
+    return partial(iter_layers_gcode, layers, z_lift=params.clearance, feedrate=params.feedrate, pen_change=params.penChangeCommand, arc_tolerance=params.arcTolerance)
+
+
+def job_to_send(request: SendGCodeRequest) -> Job:
+    if request.jobId is not None:
+        job = get_job(request.jobId)
+        status = jobs.status(job)
+        if status["status"] != "done":
+            raise HTTPException(status_code=409, detail=f"Job {job.id} is {status['status']}")
+        return job
+
+    if request.sessionId is not None:
+        session = sessions.get(request.sessionId)
+        if session is None:
+            raise HTTPException(status_code=404, detail=f"Unknown session {request.sessionId}")
+    else:
+        session = sessions.latest()
+    if session is None or session.job is None:
+        raise HTTPException(status_code=400, detail="No GCODE has been generated yet")
+    return session.job
 
 
 @app.post("/send-gcode")
 async def send_gcode_endpoint(request: SendGCodeRequest):
-    return await send_gcode(request.hostname)
+    """Queues the G-code of a job for upload to a plotter"""
+    job = job_to_send(request)
+    try:
+        dispatch = dispatcher.submit(job.params.outputFile, gcode_blocks(job), request.plotter)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"Unknown plotter {request.plotter}")
+    if not request.wait:
+        return dispatch.as_dict()
+
+    try:
+        # Shielded: the upload goes on when the request is cancelled (client gone, shutdown)
+        filename = await asyncio.shield(asyncio.wrap_future(dispatch.future))
+    except Exception as e:
+        raise upload_error(dispatcher.plotters[dispatch.assigned].hostname, e)
+    return {"message": f"GCODE successfully sent to plotter as {filename}.gcode", "dispatch": dispatch.as_dict()}
+
+
+@app.get("/plotters")
+async def plotters():
+    """State of every plotter and the queued dispatches"""
+    return dispatcher.status()
+
+
+@app.get("/dispatches/{dispatch_id}")
+async def dispatch_status(dispatch_id: str):
+    dispatch = dispatcher.get(dispatch_id)
+    if dispatch is None:
+        raise HTTPException(status_code=404, detail=f"Unknown dispatch {dispatch_id}")
+    return dispatch.as_dict()
+
+
+def submit_svg(data: SVGData):
+    """Decodes the request and queues its conversion"""
+    request_metrics = metrics.new_metrics()
+    with metrics.timed(request_metrics, "decode"):
+        svg_bytes = base64.b64decode(data.svg_base64)
+
+    # Save original SVG for debugging (e.g. SOFIA_DEBUG_SVG=test_save.svg)
+    if debug_svg_path:
+        with open(debug_svg_path, "wb") as f:
+            f.write(svg_bytes)
+
+    session = sessions.create(svg_bytes, data.params)
+    return jobs.submit(svg_bytes, data.params, request_metrics, session)
+
+
+def timed_emit(blocks, request_metrics: metrics.StageMetrics):
+    """Yields the blocks, then the per-request metrics including the time spent generating them"""
+    emit = 0.0
+    size = 0
+    blocks = iter(blocks)
+    while True:
+        start = time.perf_counter()
+        block = next(blocks, None)
+        emit += time.perf_counter() - start
+        if block is None:
+            break
+        size += len(block)
+        yield block
+
+    metrics.registry.observe("emit", emit)
+    metrics.registry.increment("gcode_base64_bytes", size)
+    breakdown = request_metrics.as_dict()
+    breakdown["timings"]["emit"] = round(emit, 6)
+    breakdown["counts"]["gcode_base64_bytes"] = size
+    yield f'", "metrics": {json.dumps(breakdown)}'
+
+
+def gcode_response(job: Job) -> StreamingResponse:
+    """Makes a finished job the G-code of its session and streams it back with the preview data"""
+    _, plot_data, request_metrics, _ = job.result
+    session_id = json.dumps(job.session.id if job.session else None)
+
+    # The G-code itself is generated lazily when it is streamed
+    blocks = gcode_blocks(job)
+
+    # It is what /send-gcode sends for the session, which becomes the most recent one
+    if job.session is not None:
+        job.session.job = job
+        sessions.get(job.session.id)
+
+    # Stream the response so the base64 G-code never sits in memory as a single string
+    def iter_response():
+        yield f'{{"message": "SVG processed successfully", "jobId": "{job.id}", "sessionId": {session_id}, "plotData": {json.dumps(plot_data)}, "gcode": "'
+        if request_metrics is None:
+            yield from iter_base64(iter_chunks(blocks()))
+            yield '"}'
+        else:
+            # The breakdown follows the G-code so it includes the time spent emitting it
+            yield from timed_emit(iter_base64(iter_chunks(blocks())), request_metrics)
+            yield "}"
+
+    return StreamingResponse(iter_response(), media_type="application/json")
 
 
 @app.post("/process-svg")
 async def process_svg(data: SVGData):
     try:
-        svg_data = base64.b64decode(data.svg_base64).decode("utf-8")
-
-        # print("SVG DATA:")
-        # print(f"svg_data[:200]: {svg_data[:400]}")
-        # print()
-
-        # Save original SVG for debugging
-        with open("test_save.svg", "w") as f:
-            f.write(svg_data)
-
-        # Extract viewbox information
-        vb_min_x, vb_min_y, vb_width, vb_height = extract_viewbox(svg_data)
-        print(f"vb_min_x: {vb_min_x}, vb_min_y: {vb_min_y}, vb_width: {vb_width}, vb_height: {vb_height}")
-
-        svg_data_stripped = strip_svg_units(svg_data)
-        paths_nested_list = process_svg_string_to_json(
-            svg_data_stripped,
-            single_layer=True,
-            tolerance=data.params.polylineTolerance,
-            optimize=data.params.optimize,
-        )
-
-        # # Total number of paths/polylines across all layers
-        # total_paths = sum(len(layer) for layer in paths_nested_list)
-        # print(f"Total number of paths/polylines across all layers: {total_paths}")
-
-        # Currently grabs only the first layer
-        paths_numpy_array = [np.array(path) for path in paths_nested_list[0]]
-
-        # Calculate scaling factors
-        scale_x = data.params.width / vb_width
-        scale_y = data.params.height / vb_height
-
-        print(f"data.params.width: {data.params.width}, data.params.height: {data.params.height}")
-        print(f"scale_x: {scale_x}, scale_y: {scale_y}")
-
-        # Scale the paths
-        scaled_paths = []
-        for path in paths_numpy_array:
-            scaled_path = np.zeros_like(path)
-            scaled_path[:, 0] = (path[:, 0] - vb_min_x) * scale_x
-            scaled_path[:, 1] = (path[:, 1] - vb_min_y) * scale_y
-            scaled_paths.append(scaled_path)
-
-        # Apply flipping if needed
-        if data.params.flipVertically:
-            for path in scaled_paths:
-                path[:, 1] = data.params.height - path[:, 1]
-
-        if data.params.flipHorizontally:
-            for path in scaled_paths:
-                path[:, 0] = data.params.width - path[:, 0]
-
-        # Generate G-code from paths
-        gcode, regular_moves, travel_moves, total_length = create_gcode(
-            scaled_paths, z_lift=data.params.clearance, size=(data.params.width, data.params.height), feedrate=data.params.feedrate, optimize=data.params.optimize
-        )
-
-        # print(f"GCODE LENGTH: {len(gcode)}\n")
-        # print(f"FIRST 100 CHARACTERS: {gcode[:100]}\n")
-        # print(f"LAST 100 CHARACTERS: {gcode[-100:]}\n")
-
-        # Set the GCODE data for sending
-        set_gcode_data(gcode, data.params.outputFile)
-
-        # Encode gcode as base64
-        gcode_base64 = base64.b64encode(gcode.encode()).decode()
-
-        return {
-            "message": "SVG processed successfully",
-            "gcode": gcode_base64,
-            "plotData": {
-                "regularMoves": truncate_decimals(regular_moves),
-                "travelMoves": truncate_decimals(travel_moves),
-                "totalLength": total_length,
-            },
-        }
+        job = submit_svg(data)
+        await asyncio.wrap_future(job.future)
+        return gcode_response(job)
     except Exception as e:
         traceback.print_exc()
         print(e)
         raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/sessions/{session_id}/process-svg")
+async def update_session(session_id: str, update: SessionUpdate):
+    """Same as /process-svg for the last SVG of a session, with only the changed parameters sent"""
+    session = sessions.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown session {session_id}, upload the SVG again")
+    try:
+        params = SVGParams(**{**session.params.model_dump(), **update.params})
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    try:
+        job = jobs.submit(session.svg_data, params, metrics.new_metrics(), session)
+        await asyncio.wrap_future(job.future)
+        # The next updates apply to these parameters only once they converted
+        session.params = params
+        return gcode_response(job)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def get_job(job_id: str):
+    job = jobs.get(job_id) or sessions.find_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+@app.post("/jobs")
+async def submit_job(data: SVGData):
+    """Queues a conversion and returns its job id right away"""
+    try:
+        job = submit_svg(data)
+    except Exception as e:
+        traceback.print_exc()
+        raise HTTPException(status_code=400, detail=str(e))
+    return jobs.status(job)
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return jobs.status(get_job(job_id))
+
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = get_job(job_id)
+    if not jobs.cancel(job):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} already finished or can't be cancelled")
+    return jobs.status(job)
+
+
+def get_finished_job(job_id: str):
+    job = get_job(job_id)
+    status = jobs.status(job)
+    if status["status"] in ("queued", "running"):
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is still {status['status']}")
+    if status["status"] != "done":
+        raise HTTPException(status_code=410, detail=f"Job {job_id} {status['status']}: {status['error']}")
+    return job
+
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """Same response as /process-svg once the job is done, also makes it the G-code to send"""
+    return gcode_response(get_finished_job(job_id))
+
+
+@app.get("/jobs/{job_id}/preview")
+async def job_preview(
+    job_id: str,
+    x0: float = 0,
+    y0: float = 0,
+    x1: float | None = None,
+    y1: float | None = None,
+    pixels: int = Query(1024, ge=1, le=8192),
+    level: int | None = None,
+):
+    """
+    Preview tiles of a finished job covering the x0, y0 - x1, y1 viewport (mm, the whole page by default),
+    at the level with about pixels across the viewport unless a level is given (see app.preview)
+
+    The jobId comes with the overview tile of /process-svg (previewFormat "tiles"). Jobs are found
+    among the last jobs of the JobManager (max_jobs) and, once it forgets them, as long as they are
+    the last G-code of one of the recent sessions (max_sessions), otherwise the answer is a 404.
+    """
+    job = get_finished_job(job_id)
+    x1 = job.params.width if x1 is None else x1
+    y1 = job.params.height if y1 is None else y1
+    return await asyncio.to_thread(lambda: job.preview().viewport(x0, y0, x1, y1, pixels, level))
+
+
+@app.post("/batch")
+async def batch(request: Request, params: str):
+    """
+    Converts every SVG of a zip archive (the request body) with the same parameters (JSON of SVGParams).
+    Returns a zip archive of the G-code files and of report.json, which lists the time or error of each file.
+    """
+    try:
+        svg_params = SVGParams(**json.loads(params))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    archive = await request.body()
+    try:
+        # The pool is shared with the interactive conversions, a batch leaves them a worker
+        result = await asyncio.to_thread(convert_archive, archive, svg_params, jobs.worker_pool(), max(jobs.max_workers - 1, 1))
+    except (zipfile.BadZipFile, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(result, media_type="application/zip", headers={"Content-Disposition": f'attachment; filename="{svg_params.outputFile}.zip"'})
+
+
+@app.get("/health")
+async def health():
+    """Answers as soon as the server is up, workers is "ready" once conversions can start right away"""
+    return {"status": "ok", "workers": "ready" if jobs.ready() else "starting", "uptimeSeconds": round(time.time() - STARTED, 3)}
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    """Stage timings and counters in the Prometheus text format (SOFIA_METRICS=1)"""
+    if not metrics.ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled, set SOFIA_METRICS=1 to enable them")
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
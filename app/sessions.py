@@ -0,0 +1,64 @@
+from collections import OrderedDict
+import threading
+import uuid
+
+from app.pipeline import SVGParams, reusable_orders
+
+
+class Session:
+    """The last uploaded SVG of a client, later requests only send new parameters"""
+
+    def __init__(self, session_id: str, svg_data: bytes, params: SVGParams):
+        self.id = session_id
+        self.svg_data = svg_data
+        self.params = params
+
+        # Last job whose G-code was sent back, it is what /send-gcode sends for this session
+        self.job = None
+
+        # Path orders of the last update from the source paths and the parameters they were computed with
+        self._orders = None
+        self._orders_params = None
+
+    def orders_for(self, params: SVGParams) -> list | None:
+        """Path orders to reuse for the parameters (see pipeline.reusable_orders)"""
+        if self._orders is not None and reusable_orders(self._orders_params, params):
+            return self._orders
+        return None
+
+    def remember_orders(self, params: SVGParams, orders: list):
+        self._orders, self._orders_params = orders, params
+
+
+class SessionStore:
+    """The most recent sessions, the oldest ones are dropped past max_sessions"""
+
+    def __init__(self, max_sessions: int = 16):
+        self.max_sessions = max_sessions
+        self._sessions: OrderedDict[str, Session] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def create(self, svg_data: bytes, params: SVGParams) -> Session:
+        session = Session(uuid.uuid4().hex, svg_data, params)
+        with self._lock:
+            self._sessions[session.id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        return session
+
+    def latest(self) -> Session | None:
+        """The most recently used session with a G-code"""
+        with self._lock:
+            return next((session for session in reversed(self._sessions.values()) if session.job is not None), None)
+
+    def find_job(self, job_id: str):
+        """The last job of a session with this id, sessions keep it after the JobManager forgets it"""
+        with self._lock:
+            return next((session.job for session in self._sessions.values() if session.job is not None and session.job.id == job_id), None)
+
+    def get(self, session_id: str) -> Session | None:
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._sessions.move_to_end(session_id)
+            return session
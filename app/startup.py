@@ -0,0 +1,66 @@
+"""
+Import-time report of the API process, to keep its cold start within a budget.
+
+Imports a module in a fresh interpreter with `python -X importtime` and lists the slowest
+top-level packages and modules. Exits with status 1 when the total is over --budget:
+
+    uv run python -m app.startup --budget 1.0
+"""
+
+from collections import defaultdict
+import argparse
+import subprocess
+import sys
+
+
+def import_times(module: str = "app.server") -> list[tuple[str, float, float]]:
+    """(module, self seconds, cumulative seconds) of every module imported by a fresh `import module`"""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        times.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return times
+
+
+def import_report(module: str = "app.server", top: int = 15) -> dict:
+    """Total import time of the module, the top-level packages and the modules that take the longest"""
+    times = import_times(module)
+    total = next((cumulative for name, _, cumulative in times if name == module), 0.0)
+
+    packages = defaultdict(float)
+    for name, self_seconds, _ in times:
+        packages[name.split(".")[0]] += self_seconds
+
+    return {
+        "module": module,
+        "seconds": total,
+        "packages": sorted(packages.items(), key=lambda item: -item[1])[:top],
+        "modules": sorted(((name, self_seconds) for name, self_seconds, _ in times), key=lambda item: -item[1])[:top],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--module", default="app.server", help="module to import (default: app.server)")
+    parser.add_argument("--top", type=int, default=15, help="packages and modules listed")
+    parser.add_argument("--budget", type=float, help="seconds the import may take")
+    args = parser.parse_args()
+
+    report = import_report(args.module, args.top)
+    print(f"import {report['module']}: {report['seconds']:.3f}s")
+    print("\nslowest packages (self time of all their modules):")
+    for name, seconds in report["packages"]:
+        print(f"  {name:<40}{seconds:>8.3f}s")
+    print("\nslowest modules (self time):")
+    for name, seconds in report["modules"]:
+        print(f"  {name:<40}{seconds:>8.3f}s")
+
+    if args.budget is not None and report["seconds"] > args.budget:
+        print(f"\nover the budget of {args.budget:.3f}s", file=sys.stderr)
+        sys.exit(1)
@@ -1,11 +1,19 @@
 import numpy as np
+import base64
 import json
+import math
+import time
 from typing import Tuple
 import xml.etree.ElementTree as ET
 import re
 from lxml import etree
-import vpype as vp
 import io
+import logging
+
+from app.metrics import timed
+from app.pathset import PathSet, as_pathset
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_PRECISION = 2
 
@@ -24,6 +32,26 @@ def fg(number, precision=DEFAULT_PRECISION):
         return f"{number:.{precision}f}".rstrip("0").rstrip(".")
 
 
+# Trailing zeros of a formatted decimal (and the dot itself if nothing is left after it)
+_TRAILING_ZEROS = re.compile(r"(\.\d*?[1-9])0+\b|\.0+\b")
+
+
+def fg_lines(template: str, values, precision=DEFAULT_PRECISION) -> str:
+    """formats rows of numbers into gcode lines at once, with the same output as fg()
+
+    template uses {} for each value of a row, e.g. "G1 X{} Y{} Z0"
+    every line (including the last one) is terminated by a newline
+    """
+    return fg_format((template + "\n") * len(values), values, precision)
+
+
+def fg_format(template: str, values, precision=DEFAULT_PRECISION) -> str:
+    """formats all the numbers of values (in row order) into a template with a {} for each one, with the same output as fg()"""
+    # adding 0.0 turns -0.0 into 0.0, fg() outputs "0" for both
+    flat = (np.asarray(values, dtype=float) + 0.0).ravel().tolist()
+    return _TRAILING_ZEROS.sub(r"\1", template.replace("{}", f"%.{precision}f") % tuple(flat))
+
+
 def truncate_decimals(data, decimal_places=3):
     """Truncate all floating point numbers in a nested list structure to a specified number of decimal places."""
     # Convert to JSON
@@ -43,17 +71,19 @@ def truncate_decimals(data, decimal_places=3):
     return truncated_json
 
 
-def extract_viewbox(svg_data: str, default_width: float = 100, default_height: float = 100) -> Tuple[float, float, float, float]:
-    """Extracts the viewBox attribute from the SVG data and returns it as a tuple of four floats"""
-    root = ET.fromstring(svg_data)
-    viewbox = root.attrib.get("viewBox")
-
+def parse_viewbox(viewbox: str | None, default_width: float = 100, default_height: float = 100) -> Tuple[float, float, float, float]:
     if viewbox:
-        return tuple(map(float, re.split("[ ,]+", viewbox)))
+        return tuple(map(float, re.split("[ ,]+", viewbox.strip())))
     else:
         return 0, 0, default_width, default_height
 
 
+def extract_viewbox(svg_data: str, default_width: float = 100, default_height: float = 100) -> Tuple[float, float, float, float]:
+    """Extracts the viewBox attribute from the SVG data and returns it as a tuple of four floats"""
+    root = ET.fromstring(svg_data)
+    return parse_viewbox(root.attrib.get("viewBox"), default_width, default_height)
+
+
 def strip_svg_units(svg_data: str) -> str:
     """Removes width and height attributes"""
     root = etree.fromstring(svg_data.encode("utf-8"))
@@ -65,7 +95,29 @@ def strip_svg_units(svg_data: str) -> str:
     return etree.tostring(root, pretty_print=True, encoding="unicode")
 
 
+# Drawings can have path data longer than the default libxml2 limits
+_SVG_PARSER = etree.XMLParser(huge_tree=True)
+
+
+def preprocess_svg(svg_data: bytes) -> tuple[Tuple[float, float, float, float], bytes]:
+    """
+    Parses the SVG once and returns its viewBox (as extract_viewbox) and the document
+    without width and height (as strip_svg_units), serialized as bytes for vpype
+    """
+    root = etree.fromstring(svg_data, _SVG_PARSER)
+    viewbox = parse_viewbox(root.attrib.get("viewBox"))
+
+    for attr in ["width", "height"]:
+        root.attrib.pop(attr, None)
+
+    return viewbox, etree.tostring(root)
+
+
 def vpype_svg_to_paths(svg_string, tolerance=0.1):
+    import vpype as vp
+
+    from app.vpype_convert import lines_to_pathset
+
     # Create a StringIO object from the SVG string
     svg_io = io.StringIO(strip_svg_units(svg_string))
 
@@ -83,170 +135,575 @@ def vpype_svg_to_paths(svg_string, tolerance=0.1):
         doc.scale(1, -1)
         doc.translate(0, center_y)
 
-    # Create a list to store all paths
-    paths = []
+    # The layer we just created (layer_id=1) as one buffer, the paths are views into it
+    return lines_to_pathset(doc.layers[1]).to_arrays()
+
+
+def clip_paths(paths, size):
+    """
+    Clips paths to the (0, 0) - size rectangle.
+
+    Every segment of every path is clipped at once (Liang-Barsky) on a single concatenated
+    point buffer. Paths are split where they leave the rectangle and the pieces end exactly
+    on its border. Points inside the rectangle are passed through untouched.
 
-    # Get the layer we just created (layer_id=1)
-    layer = doc.layers[1]
+    Args:
+        paths: PathSet (or list of (N, 2) arrays)
+        size: (width, height) of the rectangle
 
-    # Process each line in the layer
-    for line in layer:
-        # Create numpy array for the current path
-        path_points = np.zeros((len(line), 2))
+    Returns:
+        PathSet of the pieces of each path in order
+    """
+    paths = as_pathset(paths)
+    points = paths.points
+    lengths = paths.lengths
+    if len(points) == 0:
+        return PathSet.from_lengths(np.empty((0, 2)), [])
+
+    # Nothing to clip (the usual case)
+    if ((points >= 0) & (points <= size)).all():
+        return paths.select(lengths > 0)
+
+    path_ids = paths.path_ids()
+
+    # A segment goes from point k to point k + 1 of the same path
+    seg = np.flatnonzero(path_ids[:-1] == path_ids[1:])
+    p0 = points[seg]
+    p1 = points[seg + 1]
+    delta = p1 - p0
+
+    t0 = np.zeros(len(seg))
+    t1 = np.ones(len(seg))
+    rejected = np.zeros(len(seg), dtype=bool)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for p, q in (
+            (-delta[:, 0], p0[:, 0]),
+            (delta[:, 0], size[0] - p0[:, 0]),
+            (-delta[:, 1], p0[:, 1]),
+            (delta[:, 1], size[1] - p0[:, 1]),
+        ):
+            t = q / p
+            rejected |= (p == 0) & (q < 0)
+            t0 = np.where(p < 0, np.maximum(t0, t), t0)
+            t1 = np.where(p > 0, np.minimum(t1, t), t1)
+
+    # Segments only touching the border are dropped, zero length segments inside are kept
+    visible = ~rejected & (t0 < t1)
+    seg, p0, p1, delta, t0, t1 = seg[visible], p0[visible], p1[visible], delta[visible], t0[visible], t1[visible]
+
+    # Keep the original points exactly where the segment is not cut
+    clip_start = np.where((t0 == 0)[:, None], p0, p0 + t0[:, None] * delta)
+    clip_end = np.where((t1 == 1)[:, None], p1, p0 + t1[:, None] * delta)
+
+    # A new piece starts unless the previous visible segment continues uncut into this one
+    continues = np.zeros(len(seg), dtype=bool)
+    continues[1:] = (seg[1:] == seg[:-1] + 1) & (path_ids[seg[1:]] == path_ids[seg[:-1]]) & (t1[:-1] == 1) & (t0[1:] == 0)
+    starts_piece = ~continues
+
+    # Each visible segment adds its clipped end point, plus its clipped start point if it starts a piece
+    counts = 1 + starts_piece
+    end_positions = np.cumsum(counts) - 1
+    out = np.empty((end_positions[-1] + 1 if len(seg) else 0, 2))
+    out[end_positions] = clip_end
+    out[end_positions[starts_piece] - 1] = clip_start[starts_piece]
+    piece_offsets = end_positions[starts_piece] - 1
+    piece_lengths = np.diff(np.append(piece_offsets, len(out)))
+    piece_path_ids = path_ids[seg[starts_piece]]
+
+    # Single point paths have no segment, keep them if they are inside
+    singles = np.flatnonzero(lengths == 1)
+    single_points = points[paths.offsets[singles]]
+    inside = (single_points >= 0).all(axis=1) & (single_points <= size).all(axis=1)
+    pieces = PathSet.from_lengths(
+        np.concatenate([out, single_points[inside]]),
+        np.concatenate([piece_lengths, np.ones(inside.sum(), dtype=np.int64)]),
+    )
+    piece_path_ids = np.concatenate([piece_path_ids, singles[inside]])
+
+    return pieces.take(np.argsort(piece_path_ids, kind="stable"))
+
+
+def greedy_path_order(start_points, end_points):
+    """
+    Greedy nearest neighbor ordering of paths given their start and end points.
 
-        # Process each point in the line
-        for i, point in enumerate(line):
-            x, y = point.real, point.imag
-            path_points[i] = [x, y]
+    Starts with the path whose start is closest to the origin, then repeatedly picks the
+    closest remaining endpoint (ties go to start points, then to the lowest path index).
+    Endpoints are kept in a KD-tree which is rebuilt without the used endpoints once half
+    of them are gone, so the loop runs in roughly O(n log n).
 
-        # Add the path to our list
-        paths.append(path_points)
+    Returns:
+        (order, reverse): path indices in drawing order and whether each one is reversed
+    """
+    from scipy.spatial import cKDTree
 
-    return paths
+    n = len(start_points)
+    endpoints = np.concatenate([start_points, end_points])  # index i < n: start of path i, else end of path i - n
+    alive = np.ones(2 * n, dtype=bool)
 
+    order = np.empty(n, dtype=np.intp)
+    reverse = np.zeros(n, dtype=bool)
 
-def optimize_path_order(paths):
+    # Start with the path closest to origin (0,0)
+    current_idx = np.argmin(np.linalg.norm(start_points, axis=1))
+
+    tree_ids = np.arange(2 * n)
+    tree = cKDTree(endpoints)
+
+    for step in range(n):
+        if step > 0:
+            current_pos = endpoints[current_idx + n] if not reverse[step - 1] else endpoints[current_idx]
+
+            # Grow the query until it reaches an endpoint that is still available
+            k = 16
+            while True:
+                dists, hits = tree.query(current_pos, k=min(k, len(tree_ids)))
+                hits = tree_ids[np.atleast_1d(hits)]
+                dists = np.atleast_1d(dists)
+                found = alive[hits]
+                if found.any() or k >= len(tree_ids):
+                    break
+                k *= 4
+
+            # Gather every available endpoint at (numerically) the minimum distance
+            limit = dists[found].min() * (1 + 1e-9) + 1e-12
+            if dists[-1] <= limit and len(hits) < len(tree_ids):
+                hits = tree_ids[tree.query_ball_point(current_pos, limit)]
+            candidates = hits[alive[hits]]
+
+            # Same distance computation and tie breaking as a linear scan over the starts then the ends
+            candidate_dists = np.linalg.norm(endpoints[candidates] - current_pos, axis=1)
+            best = np.lexsort((candidates, candidate_dists))[0]
+            chosen = candidates[best]
+            current_idx = chosen % n
+            reverse[step] = chosen >= n
+
+        order[step] = current_idx
+        alive[current_idx] = alive[current_idx + n] = False
+
+        # Drop the used endpoints from the tree once they make up half of it
+        remaining = 2 * (n - step - 1)
+        if 0 < remaining <= len(tree_ids) // 2:
+            tree_ids = np.flatnonzero(alive)
+            tree = cKDTree(endpoints[tree_ids])
+
+    return order, reverse
+
+
+def improve_path_order(start_points, end_points, order, reverse, time_budget, neighbors=8):
+    """
+    Improves a path ordering with 2-opt moves until no move helps or time_budget (seconds) runs out.
+
+    A move reverses a run of consecutive paths (each path is reversed too), only runs whose new
+    travel moves connect endpoints that are close to each other are considered.
+
+    Returns:
+        (order, reverse): the improved ordering
+    """
+    from scipy.spatial import cKDTree
+
+    deadline = time.perf_counter() + time_budget
+    n = len(order)
+    if n < 2:
+        return order, reverse
+
+    order = order.copy()
+    reverse = reverse.copy()
+    position = np.empty(n, dtype=np.intp)
+    position[order] = np.arange(n)
+
+    # Oriented start/end point of the path drawn at each position
+    starts = np.where(reverse[:, None], end_points[order], start_points[order]).tolist()
+    ends = np.where(reverse[:, None], start_points[order], end_points[order]).tolist()
+
+    endpoints = np.concatenate([start_points, end_points])
+    _, near = cKDTree(endpoints).query(endpoints, k=min(neighbors + 1, 2 * n))
+    near = near.tolist()
+
+    def dist(a, b):
+        return math.hypot(a[0] - b[0], a[1] - b[1])
+
+    def gain(i, j):
+        """travel saved by reversing positions i..j"""
+        before = after = 0.0
+        if i > 0:
+            before += dist(ends[i - 1], starts[i])
+            after += dist(ends[i - 1], ends[j])
+        if j < n - 1:
+            before += dist(ends[j], starts[j + 1])
+            after += dist(starts[i], starts[j + 1])
+        return before - after
+
+    def reverse_run(i, j):
+        order[i : j + 1] = order[i : j + 1][::-1]
+        reverse[i : j + 1] = ~reverse[i : j + 1][::-1]
+        position[order[i : j + 1]] = np.arange(i, j + 1)
+        starts[i : j + 1], ends[i : j + 1] = ends[i : j + 1][::-1], starts[i : j + 1][::-1]
+
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for p in range(n):
+            if time.perf_counter() >= deadline:
+                break
+            path_id = order[p]
+            # raw endpoint ids of the oriented start and end of the path at position p
+            start_id, end_id = (path_id + n, path_id) if reverse[p] else (path_id, path_id + n)
+            moved = False
+            for raw_id, is_end in ((end_id, True), (start_id, False)):
+                if moved:
+                    break
+                for other_id in near[raw_id][1:]:
+                    other = other_id % n
+                    q = position[other]
+                    if q == p:
+                        continue
+                    other_is_end = (other_id >= n) != bool(reverse[q])
+                    if other_is_end != is_end:
+                        continue
+                    if is_end:
+                        # new travel between the ends at p and q: reverse the run after the first one
+                        i, j = min(p, q) + 1, max(p, q)
+                    else:
+                        # new travel between the starts at p and q: reverse the run before the last one
+                        i, j = min(p, q), max(p, q) - 1
+                    if gain(i, j) > 1e-9:
+                        reverse_run(i, j)
+                        improved = moved = True
+                        break
+
+    return order, reverse
+
+
+def optimize_path_order(paths, time_budget=0.0):
     """
     Optimize the order of paths using a nearest neighbor heuristic to minimize travel distance.
     This is a greedy approximation to the traveling salesman problem.
 
     Args:
-        paths: List of numpy arrays representing stroke paths
+        paths: PathSet (or list of (N, 2) arrays)
+        time_budget: Seconds to spend improving the greedy order with 2-opt (0 to skip)
 
     Returns:
-        List of paths in optimized order
+        PathSet of the paths in optimized order
     """
+    paths = as_pathset(paths)
     if len(paths) <= 1:
         return paths
 
-    # Convert to numpy arrays if not already
-    paths = [np.array(path) if not isinstance(path, np.ndarray) else path for path in paths]
+    return apply_path_order(paths, *path_order(paths, time_budget))
 
-    # Extract start and end points for each path
-    start_points = np.array([path[0] for path in paths])
-    end_points = np.array([path[-1] for path in paths])
 
-    # Track which paths we've used
-    unused_indices = list(range(len(paths)))
-    optimized_paths = []
+def path_order(paths, time_budget=0.0):
+    """The (order, reverse) optimize_path_order applies to the paths"""
+    paths = as_pathset(paths)
+    start_points = paths.starts()
+    end_points = paths.ends()
 
-    # Start with the path closest to origin (0,0)
-    origin = np.array([0, 0])
-    distances_to_origin = np.linalg.norm(start_points, axis=1)
-    current_idx = np.argmin(distances_to_origin)
-
-    # Current position is the end of the first path
-    current_pos = end_points[current_idx]
-    optimized_paths.append(paths[current_idx])
-    unused_indices.remove(current_idx)
-
-    # Greedily select the nearest path
-    while unused_indices:
-        remaining_start_points = start_points[unused_indices]
-        remaining_end_points = end_points[unused_indices]
-
-        # Calculate distances from current position to start of each remaining path
-        distances_to_starts = np.linalg.norm(remaining_start_points - current_pos, axis=1)
-
-        # Also consider distances to end points (in case we want to reverse the path)
-        distances_to_ends = np.linalg.norm(remaining_end_points - current_pos, axis=1)
-
-        # Choose the closest point (either start or end of a path)
-        min_start_dist = np.min(distances_to_starts)
-        min_end_dist = np.min(distances_to_ends)
-
-        if min_start_dist <= min_end_dist:
-            # Use path in normal direction
-            next_local_idx = np.argmin(distances_to_starts)
-            next_global_idx = unused_indices[next_local_idx]
-            next_path = paths[next_global_idx]
-            current_pos = end_points[next_global_idx]
-        else:
-            # Use path in reverse direction
-            next_local_idx = np.argmin(distances_to_ends)
-            next_global_idx = unused_indices[next_local_idx]
-            next_path = paths[next_global_idx][::-1]  # Reverse the path
-            current_pos = start_points[next_global_idx]
+    order, reverse = greedy_path_order(start_points, end_points)
+    if time_budget > 0:
+        order, reverse = improve_path_order(start_points, end_points, order, reverse, time_budget)
+    return order, reverse
 
-        optimized_paths.append(next_path)
-        unused_indices.remove(next_global_idx)
 
-    return optimized_paths
+def apply_path_order(paths, order, reverse):
+    return as_pathset(paths).take(order, reverse)
 
 
-def create_gcode(strokes, z_lift, size, feedrate=10000, optimize=False):
+def merge_paths(paths, tolerance):
+    """
+    Joins consecutive paths when the end of one is at most tolerance (mm) from the start of the next,
+    the pen stays down over the gap instead of lifting, travelling and plunging again.
+    Single point paths are never drawn, they are dropped.
+    """
+    paths = as_pathset(paths)
+    if tolerance <= 0 or len(paths) < 2:
+        return paths
+
+    drawn = paths.select(paths.lengths > 1)
+    gaps = np.hypot(*(drawn.starts()[1:] - drawn.ends()[:-1]).T)
+    joined = gaps <= tolerance
+    if not joined.any():
+        return drawn
+
+    # A joined path continues the previous one, only the offsets of the other paths are kept
+    boundaries = drawn.offsets[1:-1]
+    offsets = np.concatenate([[0], boundaries[~joined], drawn.offsets[-1:]])
+
+    # Drop the start of a joined path when it is the end of the previous one
+    duplicates = np.zeros(len(drawn.points), dtype=bool)
+    duplicates[boundaries[joined & (gaps == 0)]] = True
+    removed = np.concatenate([[0], np.cumsum(duplicates)])
+    return PathSet(drawn.points[~duplicates], offsets - removed[offsets])
+
+
+def adaptive_simplify(paths, tolerance, precision=DEFAULT_PRECISION):
+    """
+    Douglas-Peucker simplification of scaled paths, every path stays within tolerance (mm) of the original.
+
+    Straight runs collapse to their ends while tight curves keep the points they need. All the
+    paths are split at once: each pass finds the farthest point of every pending segment and
+    splits the segments where it is farther than tolerance. Points then landing on the same
+    G-code coordinate (precision decimals) as the next kept point, or as the start of their path
+    right before them, are dropped, path ends are kept.
+    """
+    paths = as_pathset(paths)
+    points = paths.points
+    if tolerance <= 0 or len(points) == 0:
+        return paths
+
+    nonempty = paths.lengths > 0
+    starts, ends = paths.offsets[:-1][nonempty], paths.offsets[1:][nonempty] - 1
+    keep = np.zeros(len(points), dtype=bool)
+    keep[starts] = True
+    keep[ends] = True
+
+    while True:
+        pending = ends - starts >= 2
+        starts, ends = starts[pending], ends[pending]
+        if not len(starts):
+            break
+
+        # Distance of the points between the ends of every segment to it
+        counts = ends - starts - 1
+        segment = np.repeat(np.arange(len(starts)), counts)
+        inner = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(starts + 1, counts)
+        ab = points[ends] - points[starts]
+        ab2 = (ab**2).sum(axis=1)
+        ab2[ab2 == 0] = np.inf  # closed paths, the distance is to their start
+        ax, ay = (points[inner] - points[starts][segment]).T
+        abx, aby = ab[segment].T
+        t = np.clip((ax * abx + ay * aby) / ab2[segment], 0.0, 1.0)
+        distances = np.hypot(ax - t * abx, ay - t * aby)
+
+        # The farthest point of every segment (the first one if several are as far)
+        largest = np.maximum.reduceat(distances, np.cumsum(counts) - counts)
+        candidates = np.flatnonzero(distances == largest[segment])
+        first = np.insert(segment[candidates][1:] != segment[candidates][:-1], 0, True)
+        farthest = inner[candidates[first]]
+        split = largest > tolerance
+
+        keep[farthest[split]] = True
+        starts, ends = np.concatenate([starts[split], farthest[split]]), np.concatenate([farthest[split], ends[split]])
+
+    # Points on the same output coordinate as the next kept point, or as the path start kept before them
+    kept = np.flatnonzero(keep)
+    rounded = np.round(points[kept], precision)
+    path_ids = paths.path_ids()[kept]
+    is_end = np.append(path_ids[1:] != path_ids[:-1], True)
+    is_start = np.insert(path_ids[1:] != path_ids[:-1], 0, True)
+    repeated = (rounded[1:] == rounded[:-1]).all(axis=1)
+    same = np.append(repeated, False) | np.insert(repeated & is_start[:-1], 0, False)
+    keep[kept[same & ~is_start & ~is_end]] = False
+
+    removed = np.concatenate([[0], np.cumsum(~keep)])
+    return PathSet(points[keep], paths.offsets - removed[paths.offsets])
+
+
+def prepare_paths(strokes, size, optimize=False, optimize_time_budget=0.0, merge_tolerance=0.0, simplify_tolerance=0.0, metrics=None):
+    """Simplifies, clips, orders and merges the strokes, returns the paths to emit (see iter_gcode)"""
     # Debug: Check input data structure
-    print(f"create_gcode received {len(strokes)} strokes")
-    if len(strokes) > 0:
-        print(f"First stroke type: {type(strokes[0])}")
+    logger.debug(f"prepare_paths received {len(strokes)} strokes")
+    if len(strokes) > 0 and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"First stroke type: {type(strokes[0])}")
         if hasattr(strokes[0], "shape"):
-            print(f"First stroke shape: {strokes[0].shape}")
+            logger.debug(f"First stroke shape: {strokes[0].shape}")
         else:
-            print(f"First stroke length: {len(strokes[0])}")
-        print(f"First stroke sample: {strokes[0][:3] if len(strokes[0]) > 3 else strokes[0]}")
-
-    def process_path(new_path):
-        nonlocal last_point, total_length
-        if len(new_path) > 1:
-            new_path = np.array(new_path)
-            gcodefile.append(f"G1 Z{fg(z_lift)}")
-            gcodefile.append(f"G0 X{fg(new_path[0][0])} Y{fg(new_path[0][1])}")
-
-            if last_point is not None:
-                travel_moves.append([last_point, new_path[0].tolist()])
-                total_length += np.linalg.norm(np.array(last_point) - np.array(new_path[0]))
-
-            for i in range(0, len(new_path)):
-                pt1 = new_path[i - 1]
-                pt2 = new_path[i]
-                gcodefile.append(f"G1 X{fg(pt2[0])} Y{fg(pt2[1])} Z0")
-                total_length += np.linalg.norm(pt2 - pt1)
-
-            paths_out.append(new_path)
-            regular_moves.append(new_path.tolist())
-
-            last_point = new_path[-1].tolist()
-
-    gcodefile = ["G21", f"G1 F{feedrate}", "G53 G0 Z-20"]
-
-    paths_out = []
-    regular_moves = []
-    travel_moves = []
-    last_point = None
-    total_length = 0.0
-
-    def point_in_bounds(pt):
-        return 0 <= pt[0] <= size[0] and 0 <= pt[1] <= size[1]
-
-    # First, filter all paths to only include in-bounds segments
-    filtered_paths = []
-    for path in strokes:
-        # Ensure path is a numpy array for consistent handling
-        path_array = np.array(path) if not isinstance(path, np.ndarray) else path
-        current_path = []
-        for pt in path_array:
-            if point_in_bounds(pt):
-                current_path.append(pt)
-            else:
-                if current_path:
-                    filtered_paths.append(np.array(current_path))
-                    current_path = []
-        if current_path:
-            filtered_paths.append(np.array(current_path))
+            logger.debug(f"First stroke length: {len(strokes[0])}")
+        logger.debug(f"First stroke sample: {strokes[0][:3] if len(strokes[0]) > 3 else strokes[0]}")
+
+    if simplify_tolerance > 0:
+        with timed(metrics, "simplify"):
+            simplified = adaptive_simplify(strokes, simplify_tolerance)
+        logger.debug(f"Simplified {len(as_pathset(strokes).points)} points to {len(simplified.points)}")
+        strokes = simplified
+
+    # First, clip all paths to the page
+    with timed(metrics, "clip"):
+        filtered_paths = clip_paths(strokes, size)
 
     # Apply optimization if requested
     if optimize and len(filtered_paths) > 1:
-        print(f"Optimizing {len(filtered_paths)} paths for minimal travel distance...")
-        filtered_paths = optimize_path_order(filtered_paths)
-        print("Path optimization complete.")
+        logger.debug(f"Optimizing {len(filtered_paths)} paths for minimal travel distance...")
+        with timed(metrics, "optimize"):
+            filtered_paths = optimize_path_order(filtered_paths, time_budget=optimize_time_budget)
+        logger.debug("Path optimization complete.")
+
+    if merge_tolerance > 0:
+        with timed(metrics, "merge"):
+            merged_paths = merge_paths(filtered_paths, merge_tolerance)
+        logger.debug(f"Merged {len(filtered_paths)} paths into {len(merged_paths)}")
+        filtered_paths = merged_paths
+
+    return filtered_paths
+
+
+def plot_moves(paths):
+    """Returns the preview data (regular and travel moves) and the total length of prepared paths"""
+    paths = as_pathset(paths)
+    drawn = paths.select(paths.lengths > 1)
 
-    # Process all paths in the (potentially optimized) order
-    for i, path in enumerate(filtered_paths):
-        if i == 0:
-            gcodefile.append(f"G0 X{fg(path[0][0])} Y{fg(path[0][1])}")
-        process_path(path)
+    # One conversion of the whole buffer, then each path is a slice of it
+    points = drawn.points.tolist()
+    offsets = drawn.offsets.tolist()
+    regular_moves = [points[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+    travel_moves = [[previous[-1], path[0]] for previous, path in zip(regular_moves[:-1], regular_moves[1:])]
 
-    gcodefile.append(f"G1 Z{z_lift:.2f}")
+    return regular_moves, travel_moves, paths_total_length(drawn)
 
-    gcode_all = "\n".join(gcodefile)
+
+def paths_total_length(paths):
+    """Drawn plus travel length of prepared paths, same as the total returned by plot_moves"""
+    paths = as_pathset(paths)
+    drawn = paths.select(paths.lengths > 1)
+    if not len(drawn):
+        return 0.0
+    # travel moves go from the end of each drawn path to the start of the next one
+    return float(np.hypot(*np.diff(drawn.points, axis=0).T).sum())
+
+
+def pack_preview(paths, size, preview_format="uint16"):
+    """
+    Packs prepared paths into a compact preview for the frontend.
+
+    The drawn paths are concatenated into one little-endian coordinate buffer (x, y pairs)
+    with a uint32 offsets array (path i is points[offsets[i]:offsets[i + 1]]). Travel moves
+    are implied: they go from the end of each path to the start of the next one.
+
+    preview_format is either "float32" (plain coordinates) or "uint16", where coordinates
+    are quantized over the page: x = value * scale[0], y = value * scale[1].
+    Buffers are base64 encoded.
+    """
+    paths = as_pathset(paths)
+    drawn = paths.select(paths.lengths > 1)
+    points = drawn.points
+    offsets = drawn.offsets
+
+    if preview_format == "uint16":
+        scale = np.array(size, dtype=float) / 65535
+        scale[scale <= 0] = 1.0
+        coords = np.clip(np.rint(points / scale), 0, 65535).astype("<u2")
+    elif preview_format == "float32":
+        scale = np.ones(2)
+        coords = points.astype("<f4")
+    else:
+        raise ValueError(f"Unknown preview format: {preview_format}")
+
+    return {
+        "format": preview_format,
+        "scale": scale.tolist(),
+        "points": base64.b64encode(coords.tobytes()).decode(),
+        "offsets": base64.b64encode(offsets.astype("<u4").tobytes()).decode(),
+    }
+
+
+def prepare_gcode(strokes, size, optimize=False, optimize_time_budget=0.0):
+    """Clips and orders the strokes for gcode output
+
+    Returns the paths to emit (see iter_gcode) with the preview data and the total length
+    """
+    paths = prepare_paths(strokes, size, optimize=optimize, optimize_time_budget=optimize_time_budget)
+    return paths, *plot_moves(paths)
+
+
+def iter_gcode(paths, z_lift, feedrate=10000):
+    """Yields the gcode program for already prepared paths, one block of lines per path"""
+    return iter_layers_gcode([paths], z_lift, feedrate=feedrate)
+
+
+def iter_layers_gcode(layers, z_lift, feedrate=10000, pen_change="M226", batch_points=16384, arc_tolerance=0.0):
+    """Yields the gcode program for layers of prepared paths, pausing for a pen change between layers
+
+    Paths are formatted in blocks of about batch_points points. With an arc_tolerance (mm), the runs
+    of points on a circle are drawn with G2/G3 arcs instead of one G1 move per segment
+    """
+    yield f"G21\nG1 F{feedrate}\nG53 G0 Z-20\n"
+
+    lift = f"G1 Z{fg(z_lift)}\n"
+    layers = [as_pathset(paths) for paths in layers]
+    layers = [paths for paths in layers if (paths.lengths > 1).any()] or layers[:1]
+    for layer_index, paths in enumerate(layers):
+        if layer_index > 0:
+            yield lift + pen_change + "\n"
+        if layer_index == 0 and len(paths):
+            yield fg_lines("G0 X{} Y{}", paths[0][:1])
+
+        drawn = paths.select(paths.lengths > 1)
+        start = 0
+        while start < len(drawn):
+            # The paths from start to stop have at most batch_points points (at least one path)
+            stop = int(np.searchsorted(drawn.offsets, drawn.offsets[start] + batch_points, side="right")) - 1
+            stop = min(max(stop, start + 1), len(drawn))
+            yield paths_gcode(drawn, start, stop, lift, arc_tolerance)
+            start = stop
+
+    yield f"G1 Z{z_lift:.2f}"
+
+
+def paths_gcode(paths: PathSet, start: int, stop: int, lift: str, arc_tolerance: float = 0.0) -> str:
+    """gcode of the paths start to stop: lift, travel to the start of the path, then draw it"""
+    lengths = paths.lengths[start:stop]
+    points = paths.points[paths.offsets[start] : paths.offsets[stop]]
+    if arc_tolerance > 0:
+        return arc_paths_gcode(PathSet(points, paths.offsets[start : stop + 1] - paths.offsets[start]), lift, arc_tolerance)
+
+    # Every path is formatted from its first point (the travel) followed by all its points
+    path_starts = paths.offsets[start:stop] - paths.offsets[start]
+    values = np.insert(points, path_starts, points[path_starts], axis=0)
+    template = "".join([lift + "G0 X{} Y{}\n" + "G1 X{} Y{} Z0\n" * length for length in lengths.tolist()])
+    return fg_format(template, values)
+
+
+def arc_paths_gcode(paths: PathSet, lift: str, arc_tolerance: float) -> str:
+    """gcode of the paths like paths_gcode, with G2/G3 moves for the runs of points fitting an arc"""
+    from app.arcs import CCW, CW, LINE, SKIPPED, fit_arcs
+
+    kinds, centers = fit_arcs(paths, arc_tolerance)
+    moves = {LINE: "G1 X{} Y{} Z0\n", SKIPPED: "", CW: "G2 X{} Y{} I{} J{}\n", CCW: "G3 X{} Y{} I{} J{}\n"}
+    is_start = np.zeros(len(paths.points), dtype=bool)
+    is_start[paths.offsets[:-1]] = True
+
+    # Row of values of each point: the travel to it (path starts), the point, the arc center (arc ends)
+    values = np.column_stack([paths.points, paths.points, centers])
+    used = np.zeros(values.shape, dtype=bool)
+    used[:, :2] = is_start[:, None]
+    used[:, 2:4] = (kinds != SKIPPED)[:, None]
+    used[:, 4:] = ((kinds == CW) | (kinds == CCW))[:, None]
+    template = "".join([(lift + "G0 X{} Y{}\n" if start else "") + moves[kind] for start, kind in zip(is_start.tolist(), kinds.tolist())])
+    return fg_format(template, values[used])
+
+
+def iter_chunks(blocks, chunk_size=64 * 1024):
+    """Regroups a stream of text blocks into chunks of roughly chunk_size characters"""
+    buffer = []
+    buffered = 0
+    for block in blocks:
+        buffer.append(block)
+        buffered += len(block)
+        if buffered >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            buffered = 0
+    if buffer:
+        yield "".join(buffer)
+
+
+def iter_base64(blocks):
+    """Base64 encodes a stream of text blocks without joining them first"""
+    carry = b""
+    for block in blocks:
+        data = carry + block.encode()
+        # only encode whole 3 byte groups so the pieces can be concatenated
+        cut = len(data) - len(data) % 3
+        carry = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut]).decode()
+    if carry:
+        yield base64.b64encode(carry).decode()
+
+
+def create_gcode(strokes, z_lift, size, feedrate=10000, optimize=False):
+    """Prepares the strokes and returns the whole gcode program as a single string"""
+    paths, regular_moves, travel_moves, total_length = prepare_gcode(strokes, size, optimize=optimize)
+    gcode_all = "".join(iter_gcode(paths, z_lift, feedrate=feedrate))
     return gcode_all, regular_moves, travel_moves, total_length
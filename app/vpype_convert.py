@@ -1,10 +1,26 @@
+from functools import lru_cache
 from pathlib import Path
 import vpype as vp
-import vpype_cli
+import io
 import json
+import logging
 import tempfile
 import numpy as np
 
+from app.pathset import PathSet
+
+# Same default as the `read` command of the vpype CLI (0.1mm expressed in px)
+DEFAULT_QUANTIZATION = vp.convert_length("0.1mm")
+
+
+@lru_cache
+def load_config(config_file: str = "plot.toml") -> bool:
+    """Loads a vpype config file once per process, returns whether it exists"""
+    if not Path(config_file).exists():
+        return False
+    vp.config_manager.load_config_file(config_file)
+    return True
+
 
 def process_svg_string_to_json(
     svg_string: str,
@@ -12,6 +28,7 @@ def process_svg_string_to_json(
     single_layer: bool = False,
     tolerance: float = 0.05,
     optimize: bool = False,
+    quantization: float = DEFAULT_QUANTIZATION,
 ) -> list:
     """
     Process an SVG string and return JSON object using vpype programmatically.
@@ -19,14 +36,17 @@ def process_svg_string_to_json(
     Args:
         svg_string: SVG content as string
         config_file: Path to vpype config file (optional)
+        quantization: Length of the segments curves are split into (in px)
 
     Returns:
         list: List of layers, where each layer contains a list of paths, and each path contains a list of [x, y] points
     """
 
+    import vpype_cli
+
     # Load the config file if provided
-    if config_file and Path(config_file).exists():
-        vp.config_manager.load_config_file(config_file)
+    if config_file:
+        load_config(config_file)
 
     # Create temporary files for input SVG and output JSON
     with tempfile.NamedTemporaryFile(mode="w", suffix=".svg", delete=False) as temp_svg:
@@ -38,8 +58,8 @@ def process_svg_string_to_json(
 
     try:
         # Build the pipeline using temporary file paths
-        pipeline = f'read {"-m" if single_layer else ""} "{temp_svg_path}" {"linesort" if optimize else ""} linesimplify -t {tolerance} gwrite --profile json_t "{temp_json_path}"'
-        print(f"pipeline: {pipeline}")
+        pipeline = f'read {"-m" if single_layer else ""} -q {quantization} "{temp_svg_path}" {"linesort" if optimize else ""} linesimplify -t {tolerance} gwrite --profile json_t "{temp_json_path}"'
+        logging.debug(f"pipeline: {pipeline}")
         # Execute the pipeline
         result_document = vpype_cli.execute(pipeline)
 
@@ -57,6 +77,151 @@ def process_svg_string_to_json(
         Path(temp_json_path).unlink(missing_ok=True)
 
 
+def linesort(lines: vp.LineCollection) -> vp.LineCollection:
+    """Greedy pen-up distance optimization, same as the vpype `linesort` command"""
+    if len(lines) < 2:
+        return lines
+
+    line_index = vp.LineIndex(lines[1:], reverse=True)
+    new_lines = lines.clone([lines[0]])
+
+    while len(line_index) > 0:
+        idx, reverse = line_index.find_nearest(new_lines[-1][-1])
+        line = line_index.pop(idx)
+        if line is not None:
+            if reverse:
+                line = np.flip(line)
+            new_lines.append(line)
+
+    # Keep the original order if sorting did not help
+    if lines.pen_up_length()[0] < new_lines.pen_up_length()[0]:
+        return lines
+
+    return new_lines
+
+
+def linesimplify(lines: vp.LineCollection, tolerance: float) -> vp.LineCollection:
+    """Reduce the number of segments, same as the vpype `linesimplify` command"""
+    if len(lines) < 1 or tolerance <= 0:
+        return lines
+
+    # preserve_topology must be False, otherwise intersecting lines are not simplified
+    mls = lines.as_mls().simplify(tolerance=tolerance, preserve_topology=False)
+    return lines.clone(mls)
+
+
+def process_svg_string_to_arrays(
+    svg_string: str | bytes,
+    single_layer: bool = False,
+    tolerance: float = 0.05,
+    optimize: bool = False,
+    quantization: float = DEFAULT_QUANTIZATION,
+) -> list:
+    """
+    Process an SVG string in memory and return the paths as numpy arrays.
+
+    This is equivalent to `process_svg_string_to_json` but skips the temporary files, the
+    gwrite text output and the 2 decimal rounding it implies.
+
+    Args:
+        svg_string: SVG content as string or bytes
+        single_layer: Merge all the SVG geometries in a single layer, otherwise see read_layer_document
+        tolerance: Tolerance used by linesimplify (in px), 0 to keep all the points
+        optimize: Sort the lines to minimize pen-up travel
+        quantization: Length of the segments curves are split into (in px)
+
+    Returns:
+        list: List of layers, each one a PathSet of [x, y] points
+    """
+
+    if single_layer:
+        line_collection, width, height = vp.read_svg(svg_file(svg_string), quantization=quantization)
+        document = vp.Document()
+        document.add(line_collection, layer_id=1, with_metadata=True)
+        document.extend_page_size((width, height))
+    else:
+        document = read_layer_document(svg_string, quantization)
+
+    for layer_id in list(document.layers):
+        lines = document.layers[layer_id]
+        if optimize:
+            lines = linesort(lines)
+        document.replace(linesimplify(lines, tolerance), layer_id)
+
+    # Mirror the `invert_y` option of the json_t gwrite profile (flip around the bounds center)
+    bounds = document.bounds()
+    if bounds:
+        center_y = 0.5 * (bounds[1] + bounds[3])
+        document.translate(0, -center_y)
+        document.scale(1, -1)
+        document.translate(0, center_y)
+
+    logging.info(f"Processed {len(document.layers)} layers in memory")
+
+    return [lines_to_pathset(layer) for layer in document.layers.values()]
+
+
+def svg_file(svg: str | bytes) -> io.IOBase:
+    """In memory file for the vpype readers, bytes avoid decoding large documents"""
+    return io.BytesIO(svg) if isinstance(svg, bytes) else io.StringIO(svg)
+
+
+def lines_to_pathset(lines: vp.LineCollection) -> PathSet:
+    """The complex lines of vpype as a PathSet, a complex array is already laid out as (x, y) pairs"""
+    lines = list(lines)
+    points = np.concatenate(lines).astype(complex, copy=False).view(np.float64).reshape(-1, 2) if lines else np.empty((0, 2))
+    return PathSet.from_lengths(points, [len(line) for line in lines])
+
+
+def pathset_to_lines(paths: PathSet) -> vp.LineCollection:
+    points = np.ascontiguousarray(paths.points, dtype=np.float64).view(complex).ravel()
+    return vp.LineCollection(np.split(points, paths.offsets[1:-1]) if len(paths) else [])
+
+
+def read_layer_document(svg_string: str | bytes, quantization: float = DEFAULT_QUANTIZATION) -> vp.Document:
+    """
+    Reads the layers of an SVG: its top-level groups, or when it has at most one of them the
+    stroke colours, so files coloured through the stroke attribute get one layer per colour.
+    """
+    document = vp.read_multilayer_svg(svg_file(svg_string), quantization=quantization)
+    if len(document.layers) <= 1:
+        by_stroke = vp.read_svg_by_attributes(svg_file(svg_string), attributes=["stroke"], quantization=quantization)
+        if len(by_stroke.layers) > 1:
+            return by_stroke
+    return document
+
+
+def read_svg_layers(svg_string: str | bytes, quantization: float = DEFAULT_QUANTIZATION) -> list:
+    """Reads the vpype layers of an SVG string (without any processing) as PathSets, see read_layer_document"""
+    document = read_layer_document(svg_string, quantization)
+    return [lines_to_pathset(layer) for layer in document.layers.values()]
+
+
+def simplify_paths(paths: PathSet, tolerance: float = 0.05, optimize: bool = False) -> PathSet:
+    """linesort (if optimize) and linesimplify a single layer"""
+    lines = pathset_to_lines(paths)
+    if optimize:
+        lines = linesort(lines)
+    return lines_to_pathset(linesimplify(lines, tolerance))
+
+
+def bounds_center_y(layers: list) -> float | None:
+    """Vertical center of the bounds of layers of PathSets (None if there are no points)"""
+    ys = [paths.points[:, 1] for paths in layers if len(paths.points)]
+    if not ys:
+        return None
+    return 0.5 * (min(y.min() for y in ys) + max(y.max() for y in ys))
+
+
+def invert_y(paths: PathSet, center_y: float | None) -> PathSet:
+    """Flips the paths around center_y, like the `invert_y` gwrite option"""
+    if center_y is None:
+        return paths
+    points = paths.points.copy()
+    points[:, 1] = center_y - (points[:, 1] - center_y)
+    return PathSet(points, paths.offsets)
+
+
 if __name__ == "__main__":
     with open("example-files/curves-final-SM1.svg", "r") as f:
         svg_string = f.read()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+"""
+Benchmarks every stage of the SVG to G-code pipeline, over the SVGs in example-files/
+and over synthetic drawings of increasing size.
+
+For each input and stage it records the wall time (best of --repeat runs), the peak
+memory allocated by the stage (tracemalloc, measured in a separate run) and the size
+of its output. Results are saved as JSON so two runs can be compared:
+
+    uv run python benchmark.py -o before.json
+    uv run python benchmark.py -o after.json
+    uv run python benchmark.py --compare before.json after.json
+"""
+
+from pathlib import Path
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from app.utils import extract_viewbox, strip_svg_units, preprocess_svg, adaptive_simplify, clip_paths, optimize_path_order, iter_gcode, plot_moves, truncate_decimals, pack_preview
+from app.vpype_convert import process_svg_string_to_json, process_svg_string_to_arrays
+from app.pipeline import SVGParams, transform_paths, motion_estimate
+from app.pathset import PathSet
+
+EXAMPLES_DIR = Path(__file__).parent / "example-files"
+SYNTHETIC_SIZES = [10_000, 100_000, 1_000_000]  # total number of points
+
+PARAMS = SVGParams(
+    width=300,
+    height=200,
+    outputFile="benchmark",
+    polylineTolerance=0.1,
+    clearance=2,
+    optimize=True,
+    feedrate=5000,
+    flipVertically=True,
+    flipHorizontally=False,
+)
+
+
+def synthetic_svg(n_points: int, points_per_path: int = 100, seed: int = 0) -> str:
+    """Random walk polylines with n_points points in total, some of them crossing the page edge"""
+    rng = np.random.default_rng(seed)
+    n_paths = max(1, n_points // points_per_path)
+    starts = rng.uniform(0, 1000, (n_paths, 1, 2))
+    walks = starts + np.cumsum(rng.normal(0, 3, (n_paths, points_per_path, 2)), axis=1)
+
+    paths = []
+    for walk in walks:
+        coords = " ".join(f"{x:.2f},{y:.2f}" for x, y in walk)
+        paths.append(f'<path d="M{coords}" fill="none" stroke="black"/>')
+    return '<svg xmlns="http://www.w3.org/2000/svg" width="300mm" height="200mm" viewBox="0 0 1000 1000">\n' + "\n".join(paths) + "\n</svg>"
+
+
+def output_size(value) -> int:
+    """Size in bytes of a stage output"""
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, (np.ndarray, PathSet)):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(output_size(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(output_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def stages(svg: str):
+    """(name, function) of each stage, a function takes the outputs of the previous stages"""
+    size = (PARAMS.width, PARAMS.height)
+    return [
+        ("extract_viewbox", lambda out: extract_viewbox(svg)),
+        ("strip_svg_units", lambda out: strip_svg_units(svg)),
+        # Both of the above in a single parse, as done by the pipeline
+        ("preprocess_svg", lambda out: preprocess_svg(svg.encode())),
+        ("process_svg_string_to_json", lambda out: process_svg_string_to_json(out["strip_svg_units"], single_layer=True, tolerance=PARAMS.polylineTolerance)),
+        ("process_svg_string_to_arrays", lambda out: process_svg_string_to_arrays(out["preprocess_svg"][1], single_layer=True, tolerance=PARAMS.polylineTolerance)),
+        ("transform_paths", lambda out: transform_paths(out["process_svg_string_to_arrays"][0], out["extract_viewbox"], PARAMS)),
+        # Simplification in mm of the scaled paths (simplifyTolerance), the later stages don't use it
+        ("adaptive_simplify", lambda out: adaptive_simplify(out["transform_paths"], 0.05)),
+        ("clip_paths", lambda out: clip_paths(out["transform_paths"], size)),
+        ("optimize_path_order", lambda out: optimize_path_order(out["clip_paths"])),
+        # The G-code emission of create_gcode, without the path preparation measured above
+        ("create_gcode", lambda out: "".join(iter_gcode(out["optimize_path_order"], z_lift=PARAMS.clearance, feedrate=PARAMS.feedrate))),
+        ("plot_moves", lambda out: plot_moves(out["optimize_path_order"])),
+        ("truncate_decimals", lambda out: truncate_decimals(out["plot_moves"][0]) + truncate_decimals(out["plot_moves"][1])),
+        ("pack_preview", lambda out: pack_preview(out["optimize_path_order"], size)),
+        ("estimate_motion", lambda out: motion_estimate([out["optimize_path_order"]], PARAMS)),
+    ]
+
+
+def run_stages(svg: str, repeat: int, memory: bool = True) -> dict:
+    results = {}
+    outputs = {}
+    for name, stage in stages(svg):
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            outputs[name] = stage(outputs)
+            times.append(time.perf_counter() - start)
+
+        peak = None
+        if memory:  # tracemalloc slows Python code down a lot, so it gets its own run
+            tracemalloc.start()
+            stage(outputs)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        results[name] = {"time_s": min(times), "peak_mb": peak / 2**20 if peak is not None else None, "output_bytes": output_size(outputs[name])}
+
+    paths = outputs["process_svg_string_to_arrays"][0]
+    results["_input"] = {"svg_bytes": len(svg.encode()), "paths": len(paths), "points": len(paths.points)}
+    return results
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def run(args) -> dict:
+    inputs = {}
+    if not args.no_examples:
+        for svg_file in sorted(EXAMPLES_DIR.glob("*.svg")):
+            inputs[svg_file.name] = svg_file.read_text()
+    for n_points in args.sizes:
+        inputs[f"synthetic-{n_points}"] = synthetic_svg(n_points)
+
+    results = {}
+    for name, svg in inputs.items():
+        start = time.perf_counter()
+        results[name] = run_stages(svg, args.repeat, memory=not args.no_memory)
+        print(f"{name}: {time.perf_counter() - start:.2f}s", file=sys.stderr)
+
+    return {
+        "meta": {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(before: dict, after: dict):
+    """Prints the time and peak memory of each stage of the inputs found in both runs"""
+    print(f"before: {before['meta']['commit']}  after: {after['meta']['commit']}")
+    for name, stages_after in after["results"].items():
+        stages_before = before["results"].get(name)
+        if stages_before is None:
+            continue
+        print(f"\n{name} ({stages_after['_input']['points']} points)")
+        print(f"  {'stage':<30}{'before s':>10}{'after s':>10}{'ratio':>8}{'before MB':>11}{'after MB':>11}")
+        for stage, b in stages_before.items():
+            a = stages_after.get(stage)
+            if stage == "_input" or a is None:
+                continue
+            ratio = a["time_s"] / b["time_s"] if b["time_s"] else float("nan")
+            memory = "".join(f"{mb:>11.1f}" if mb is not None else f"{'-':>11}" for mb in (b["peak_mb"], a["peak_mb"]))
+            print(f"  {stage:<30}{b['time_s']:>10.4f}{a['time_s']:>10.4f}{ratio:>8.2f}{memory}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="JSON file for the results (default: stdout)")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each stage, the best one is kept")
+    parser.add_argument("--sizes", type=int, nargs="*", default=SYNTHETIC_SIZES, help="point counts of the synthetic drawings")
+    parser.add_argument("--no-examples", action="store_true", help="skip the files in example-files/")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) peak memory measurement")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two result files instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        before, after = (json.loads(Path(f).read_text()) for f in args.compare)
+        compare(before, after)
+    else:
+        report = run(args)
+        if args.output:
+            Path(args.output).write_text(json.dumps(report, indent=2))
+        else:
+            print(json.dumps(report, indent=2))
@@ -0,0 +1,38 @@
+"""Multi-layer conversions of the example files (python -m pytest tests, or python -m unittest discover tests)"""
+
+from pathlib import Path
+import unittest
+
+from app.pipeline import SVGParams, convert_svg_layers
+from app.utils import iter_layers_gcode
+from app.vpype_convert import read_svg_layers
+
+EXAMPLES = Path(__file__).resolve().parent.parent / "example-files"
+
+
+def params(**overrides) -> SVGParams:
+    values = dict(
+        width=300, height=200, outputFile="test", polylineTolerance=0.1, clearance=2, optimize=False,
+        feedrate=5000, flipVertically=True, flipHorizontally=False, multiLayer=True,
+    )
+    return SVGParams(**{**values, **overrides})
+
+
+class MultiLayerTest(unittest.TestCase):
+    def test_stroke_colours_are_layers(self):
+        layers = read_svg_layers((EXAMPLES / "4-colors.svg").read_bytes())
+        self.assertEqual([len(paths) for paths in layers], [25, 25, 25, 25])
+
+    def test_groups_are_layers(self):
+        layers = read_svg_layers((EXAMPLES / "4-groups.svg").read_bytes())
+        self.assertEqual(len(layers), 4)
+
+    def test_pen_change_between_colours(self):
+        conversion = convert_svg_layers((EXAMPLES / "4-colors.svg").read_bytes(), params())
+        self.assertEqual(len(conversion.layers), 4)
+        gcode = "".join(iter_layers_gcode(conversion.layers, 2, pen_change="M226"))
+        self.assertEqual(gcode.count("M226"), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+"""adaptive_simplify on small drawings (python -m pytest tests, or python -m unittest discover tests)"""
+
+import unittest
+
+import numpy as np
+
+from app.utils import adaptive_simplify
+
+
+class AdaptiveSimplifyTest(unittest.TestCase):
+    def simplify(self, path, tolerance=0.05) -> list:
+        return adaptive_simplify([path], tolerance)[0].tolist()
+
+    def test_path_back_through_its_start(self):
+        self.assertEqual(self.simplify([[0, 0], [10, 0], [0, 0], [0, 10]]), [[0, 0], [10, 0], [0, 0], [0, 10]])
+
+    def test_vertex_rounding_near_the_start(self):
+        path = [[5, 5], [20, 5], [20, 20], [5, 5.001], [5, 30]]
+        self.assertEqual(self.simplify(path), path)
+
+    def test_closed_path(self):
+        path = [[0, 0], [10, 0], [10, 10], [0, 0]]
+        self.assertEqual(self.simplify(path), path)
+
+    def test_repeated_output_coordinates(self):
+        # Kept by the simplification, (10, 0) is then drawn at the coordinate of the next point
+        self.assertEqual(self.simplify([[0, 0], [10, 0], [10.004, 0.003], [0, 10]], 0.0001), [[0, 0], [10.004, 0.003], [0, 10]])
+
+    def test_within_tolerance(self):
+        angles = np.linspace(0, np.pi, 200)
+        arc = np.column_stack([np.cos(angles), np.sin(angles)]) * 50
+        simplified = np.array(self.simplify(arc, 0.1))
+        self.assertLess(len(simplified), len(arc))
+        self.assertLessEqual(np.abs(np.hypot(*simplified.T) - 50).max(), 1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()